@@ -0,0 +1,444 @@
+"""Нагрузочный тест бота без сети.
+
+Поднимает локальные заглушки TMDB (/discover, /movie/{id}, /trending) и
+Кинопоиска (/movie) с настраиваемой задержкой и долей ошибок, подменяет
+сессию Telegram и прогоняет виртуальных пользователей по всему сценарию:
+/start -> жанры -> настроение -> тип -> реакции на карточки. Пользователь
+нажимает кнопки последней полученной клавиатуры, поэтому сценарий следует
+за ботом; inline-кнопки (UI_MODE=inline) нажимаются как callback_query.
+В конце печатает пропускную способность, p50/p95/p99 задержки обновлений
+по шагам и число запросов к каждому API и к Telegram.
+
+    python benchmark.py --users 200 --concurrency 50 --latency 80 --error-rate 0.02
+
+Переменные окружения бота можно задать как обычно (например,
+TMDB_RATE_LIMIT); по умолчанию лимиты подняты, чтобы мерить сам бот.
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+import zlib
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+from vocabulary import DONE_BUTTON, GENRES, MEDIA_TYPES, MOODS, NEXT_BUTTON, RESTART_YES_BUTTON, WATCH_BUTTON
+
+TMDB_PAGE_SIZE = 20
+# Общий пул id в порядке популярности: выдача любого запроса - его подмножество,
+# поэтому популярные карточки попадают в ответы разных запросов, как у TMDB
+ID_POOL_SIZE = 3000
+ID_MATCH_PERCENT = 30
+# Постер заглушки: 512 КБ, отдаётся кусками по 16 КБ без Content-Length
+POSTER_BODY = b"\xff\xd8\xff" + bytes(512_000 - 3)
+POSTER_CHUNK = 16 * 1024
+
+# Имена жанров TMDB (ru-RU) по id - как их возвращает /movie/{id}
+TMDB_GENRES = {
+    35: "комедия", 18: "драма", 878: "фантастика", 28: "боевик", 53: "триллер",
+    10749: "мелодрама", 27: "ужасы", 9648: "детектив", 12: "приключения",
+    16: "мультфильм", 10751: "семейный", 36: "история", 99: "документальный",
+}
+KINOPOISK_GENRES = ("комедия", "драма", "фантастика", "боевик", "триллер", "мелодрама",
+                    "ужасы", "детектив", "приключения", "семейный", "мультфильм")
+
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Перцентиль по ближайшему рангу"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+class FakeUpstream:
+    """Заглушки TMDB и Кинопоиска на одном aiohttp-сервере"""
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.5, error_rate: float = 0.0,
+                 pages: int = 10, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.pages = pages
+        self.random = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.errors: Counter = Counter()
+        self._runner: Optional[web.AppRunner] = None
+        self.url = ""
+        self._matches: Dict[str, List[int]] = {}
+
+    async def _respond(self, endpoint: str, payload) -> web.Response:
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * (1 + self.jitter * (2 * self.random.random() - 1)))
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors[endpoint] += 1
+            return web.json_response({"status_message": "injected error"}, status=500)
+        return web.json_response(payload)
+
+    def _ids(self, seed: str, page: int, count: int) -> List[int]:
+        if page > self.pages:
+            return []
+        # Стабильные id: те же параметры - те же карточки; разные параметры
+        # пересекаются примерно на ID_MATCH_PERCENT выдачи
+        matches = self._matches.get(seed)
+        if matches is None:
+            matches = self._matches[seed] = [
+                item_id for item_id in range(1, ID_POOL_SIZE + 1)
+                if zlib.crc32(f"{seed}:{item_id}".encode()) % 100 < ID_MATCH_PERCENT
+            ]
+        return matches[(page - 1) * count:page * count]
+
+    async def tmdb_discover(self, request: web.Request) -> web.Response:
+        media_type = request.match_info["media_type"]
+        page = int(request.query.get("page", 1))
+        seed = f"{media_type}:{request.query.get('with_genres', '')}"
+        results = [{"id": item_id} for item_id in self._ids(seed, page, TMDB_PAGE_SIZE)]
+        return await self._respond("tmdb /discover", {"page": page, "results": results})
+
+    async def tmdb_detail(self, request: web.Request) -> web.Response:
+        item_id = int(request.match_info["item_id"])
+        rng = random.Random(item_id)
+        genres = rng.sample(sorted(TMDB_GENRES), 2)
+        title_field = "title" if request.match_info["media_type"] == "movie" else "name"
+        date_field = "release_date" if request.match_info["media_type"] == "movie" else "first_air_date"
+        return await self._respond("tmdb /movie/{id}", {
+            "id": item_id,
+            title_field: f"Фильм {item_id}",
+            "original_" + title_field: f"Movie {item_id}",
+            "genres": [{"id": g, "name": TMDB_GENRES[g]} for g in genres],
+            "overview": "Описание " * 20,
+            date_field: f"{rng.randint(1970, 2025)}-01-01",
+            "vote_average": round(rng.uniform(5, 9), 1),
+            "vote_count": rng.randint(10, 50000),
+            "runtime": rng.randint(80, 180),
+            "poster_path": f"/{item_id}.jpg",
+        })
+
+    async def tmdb_trending(self, request: web.Request) -> web.Response:
+        media_type = request.match_info["media_type"]
+        seed = f"trending:{media_type}:{request.match_info['window']}"
+        if media_type == "tv":
+            fields = lambda item_id: {"name": f"Сериал {item_id}", "first_air_date": "2025-01-01"}
+        else:
+            fields = lambda item_id: {"title": f"Фильм {item_id}", "release_date": "2025-01-01"}
+        results = [{"id": item_id, "vote_average": 7.5, **fields(item_id)}
+                   for item_id in self._ids(seed, 1, TMDB_PAGE_SIZE)]
+        return await self._respond("tmdb /trending", {"page": 1, "results": results})
+
+    async def tmdb_image(self, request: web.Request) -> web.StreamResponse:
+        self.calls["tmdb /poster"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        # Крупная картинка по частям, как отдаёт CDN: клиент должен дочитать её до конца
+        response = web.StreamResponse(headers={"Content-Type": "image/jpeg"})
+        await response.prepare(request)
+        body = POSTER_BODY
+        for start in range(0, len(body), POSTER_CHUNK):
+            await response.write(body[start:start + POSTER_CHUNK])
+            await asyncio.sleep(0)
+        await response.write_eof()
+        return response
+
+    async def kinopoisk_movie(self, request: web.Request) -> web.Response:
+        page = int(request.query.get("page", 1))
+        limit = int(request.query.get("limit", 10))
+        genre = request.query.get("genres.name", "")
+        seed = f"{request.query.get('type', '')}:{genre}"
+        docs = []
+        for item_id in self._ids(seed, page, limit):
+            rng = random.Random(item_id)
+            genres = {genre} if genre else set()
+            genres.add(rng.choice(KINOPOISK_GENRES))
+            docs.append({
+                "id": item_id,
+                "name": f"Фильм {item_id}",
+                "alternativeName": f"Movie {item_id}",
+                "year": rng.randint(1970, 2025),
+                "rating": {"kp": round(rng.uniform(5, 9), 1)},
+                "votes": {"kp": rng.randint(10, 50000)},
+                "genres": [{"name": name} for name in sorted(genres)],
+                "description": "Описание " * 20,
+                "movieLength": rng.randint(80, 180),
+                "type": request.query.get("type", "movie"),
+            })
+        return await self._respond("kinopoisk /movie", {"docs": docs, "page": page, "limit": limit})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        app = web.Application()
+        app.router.add_get("/tmdb/discover/{media_type}", self.tmdb_discover)
+        app.router.add_get("/tmdb/trending/{media_type}/{window}", self.tmdb_trending)
+        app.router.add_get("/tmdb/{media_type}/{item_id:\\d+}", self.tmdb_detail)
+        app.router.add_get("/kinopoisk/movie", self.kinopoisk_movie)
+        app.router.add_get("/images/{name}", self.tmdb_image)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на заглушках API")
+    parser.add_argument("--users", type=int, default=100, help="виртуальных пользователей в раунде")
+    parser.add_argument("--concurrency", type=int, default=20, help="одновременно активных пользователей")
+    parser.add_argument("--reactions", type=int, default=6, help="реакций на карточки у каждого пользователя")
+    parser.add_argument("--rounds", type=int, default=2, help="раундов (второй - на прогретых кешах)")
+    parser.add_argument("--latency", type=float, default=50, help="задержка ответа API, мс")
+    parser.add_argument("--jitter", type=float, default=0.5, help="разброс задержки, доля от --latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов API с ошибкой 500")
+    parser.add_argument("--pages", type=int, default=10, help="страниц выдачи у каждого запроса к API")
+    parser.add_argument("--think-time", type=float, default=0, help="пауза пользователя между действиями, мс")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def configure_env(upstream_url: str, data_dir: str) -> None:
+    """Окружение бота до импорта movie_bot; заданные снаружи значения не трогаются"""
+    defaults = {
+        "BOT_TOKEN": "123456:benchmark",
+        "LOG_LEVEL": "WARNING",
+        "DATA_DIR": data_dir,
+        "TMDB_API_KEY": "benchmark",
+        "KINOPOISK_API_KEY": "benchmark",
+        "TMDB_RATE_LIMIT": "100000",
+        "TMDB_RATE_BURST": "100000",
+        "KINOPOISK_RATE_LIMIT": "100000",
+        "KINOPOISK_RATE_BURST": "100000",
+        "KINOPOISK_DAILY_QUOTA": "0",
+        "PREFETCH_ENABLED": "0",
+        "METRICS_PORT": "0",
+        "TELEGRAM_CHAT_RATE": "0",
+        "TELEGRAM_GLOBAL_RATE": "0",
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+    # Адреса API всегда указывают на заглушки
+    os.environ["TMDB_BASE_URL"] = f"{upstream_url}/tmdb"
+    os.environ["TMDB_IMAGE_BASE_URL"] = f"{upstream_url}/images"
+    os.environ["KINOPOISK_BASE_URL"] = f"{upstream_url}/kinopoisk"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def create_telegram(bot_module):
+    """Сессия Telegram, которая отвечает на всё сразу и запоминает клавиатуры
+    (текст кнопки -> callback_data, None у обычной клавиатуры) и последнее
+    сообщение бота в каждом чате"""
+    from aiogram.client.session.base import BaseSession
+    from aiogram.methods import (
+        EditMessageCaption, EditMessageMedia, EditMessageReplyMarkup, EditMessageText,
+    )
+    from aiogram.types import Chat, InputFile, Message, PhotoSize, User
+
+    edits = (EditMessageCaption, EditMessageMedia, EditMessageReplyMarkup, EditMessageText)
+    bot_user = User(id=bot_module.bot.id, is_bot=True, first_name="bot")
+
+    def photo_sizes(file_id: Optional[str]):
+        return [PhotoSize(file_id=file_id, file_unique_id=file_id, width=500, height=750)] if file_id else None
+
+    class FakeTelegramSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            self.calls: Counter = Counter()
+            self.keyboards: Dict[int, Dict[str, Optional[str]]] = {}
+            self.messages: Dict[int, Message] = {}
+            self._message_id = 0
+
+        def _remember_keyboard(self, chat_id: int, markup, edited: bool) -> None:
+            if hasattr(markup, "keyboard"):
+                self.keyboards[chat_id] = {button.text: None for row in markup.keyboard for button in row}
+            elif hasattr(markup, "inline_keyboard"):
+                self.keyboards[chat_id] = {button.text: button.callback_data
+                                           for row in markup.inline_keyboard for button in row}
+            elif edited:
+                # Правка без клавиатуры убирает inline-кнопки
+                self.keyboards.pop(chat_id, None)
+
+        async def make_request(self, bot, method, timeout=None):
+            self.calls[type(method).__name__] += 1
+            chat_id = getattr(method, "chat_id", None)
+            if chat_id is not None:
+                self._remember_keyboard(chat_id, getattr(method, "reply_markup", None), isinstance(method, edits))
+            if isinstance(method, edits):
+                message = self.messages.get(chat_id)
+                if message is None:
+                    return True
+                changes = {}
+                if isinstance(method, EditMessageText):
+                    changes["text"] = method.text
+                elif isinstance(method, EditMessageCaption):
+                    changes["caption"] = method.caption
+                elif isinstance(method, EditMessageMedia):
+                    changes.update(caption=method.media.caption, photo=photo_sizes(method.media.media))
+                message = message.model_copy(update=changes)
+                self.messages[chat_id] = message
+                return message.as_(bot)
+            photo = getattr(method, "photo", None)
+            if isinstance(photo, InputFile):
+                self.calls["photo uploads"] += 1
+                if len(getattr(photo, "data", b"")) != len(POSTER_BODY):
+                    self.calls["truncated photo uploads"] += 1
+                photo = f"photo-{self._message_id}"
+            if method.__returning__ is Message:
+                self._message_id += 1
+                message = Message(message_id=self._message_id, date=datetime.datetime.now(),
+                                  chat=Chat(id=chat_id or 0, type="private"), from_user=bot_user,
+                                  text=getattr(method, "text", None),
+                                  caption=getattr(method, "caption", None),
+                                  photo=photo_sizes(photo))
+                if chat_id is not None:
+                    self.messages[chat_id] = message
+                return message
+            return True
+
+        async def stream_content(self, *args, **kwargs):
+            yield b""
+
+        async def close(self):
+            pass
+
+    session = FakeTelegramSession()
+    # Темп отправки остаётся в цепочке запросов, как у настоящей сессии
+    session.middleware(bot_module.send_limiter)
+    bot_module.bot.session = session
+    return session
+
+
+class SimulatedUsers:
+    """Виртуальные пользователи, которые проходят сценарий подбора"""
+
+    def __init__(self, bot_module, session, args: argparse.Namespace):
+        from aiogram.types import CallbackQuery, Chat, Message, Update, User
+        self._types = (CallbackQuery, Chat, Message, Update, User)
+        self.m = bot_module
+        self.session = session
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.failures = 0
+        self._update_id = 0
+
+    def _update(self, chat_id: int, text: str):
+        """Текст или, если у кнопки есть callback_data, нажатие inline-кнопки"""
+        CallbackQuery, Chat, Message, Update, User = self._types
+        self._update_id += 1
+        user = User(id=chat_id, is_bot=False, first_name="bench")
+        data = self.session.keyboards.get(chat_id, {}).get(text)
+        if data is not None:
+            return Update(update_id=self._update_id, callback_query=CallbackQuery(
+                id=str(self._update_id), from_user=user, chat_instance=str(chat_id),
+                message=self.session.messages[chat_id], data=data,
+            ))
+        return Update(update_id=self._update_id, message=Message(
+            message_id=self._update_id, date=datetime.datetime.now(),
+            chat=Chat(id=chat_id, type="private"), from_user=user, text=text,
+        ))
+
+    async def _send(self, chat_id: int, step: str, text: str) -> None:
+        if self.args.think_time:
+            await asyncio.sleep(self.args.think_time / 1000)
+        update = self._update(chat_id, text)
+        start = time.perf_counter()
+        try:
+            await self.m.dp.feed_update(self.m.bot, update)
+        except Exception:
+            self.failures += 1
+        self.latencies[step].append(time.perf_counter() - start)
+
+    async def run_user(self, chat_id: int) -> None:
+        rng = random.Random(chat_id)
+        await self._send(chat_id, "start", "/start")
+        for genre in rng.sample(GENRES, rng.randint(1, 2)):
+            await self._send(chat_id, "genres", genre)
+        await self._send(chat_id, "genres", DONE_BUTTON)
+        await self._send(chat_id, "mood", rng.choice(MOODS))
+        await self._send(chat_id, "mood", DONE_BUTTON)
+        await self._send(chat_id, "search", rng.choice(MEDIA_TYPES))
+
+        for i in range(self.args.reactions):
+            keyboard = self.session.keyboards.get(chat_id, {})
+            if RESTART_YES_BUTTON in keyboard:
+                await self._send(chat_id, "restart", RESTART_YES_BUTTON)
+            elif NEXT_BUTTON in keyboard:
+                last = i == self.args.reactions - 1
+                await self._send(chat_id, "reaction", WATCH_BUTTON if last else NEXT_BUTTON)
+            else:
+                break  # бот ничего не нашёл или сценарий сбился
+
+    async def run_round(self, first_chat_id: int) -> float:
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def limited(chat_id: int):
+            async with semaphore:
+                await self.run_user(chat_id)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(limited(first_chat_id + i) for i in range(self.args.users)))
+        return time.perf_counter() - start
+
+
+def report(title: str, elapsed: float, users: SimulatedUsers, upstream: FakeUpstream,
+           session, bot_module) -> None:
+    all_latencies = [value for values in users.latencies.values() for value in values]
+    print(f"\n=== {title} ===")
+    print(f"updates: {len(all_latencies)} in {elapsed:.2f}s -> {len(all_latencies) / elapsed:.1f} updates/s, "
+          f"failures: {users.failures}")
+    print(f"{'step':<10}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    rows = list(users.latencies.items()) + [("all", all_latencies)]
+    for step, values in rows:
+        print(f"{step:<10}{len(values):>8}" + "".join(
+            f"{percentile(values, p) * 1000:>10.1f}" for p in (50, 95, 99, 100)))
+    calls = ", ".join(f"{endpoint}={count} (errors {upstream.errors[endpoint]})"
+                      for endpoint, count in sorted(upstream.calls.items()))
+    print(f"upstream calls: {calls or 'none'}")
+    print(f"telegram calls: {dict(session.calls)}, send limiter: {bot_module.send_limiter.stats()}")
+    print(f"media cache: {bot_module.media_cache.stats()}")
+    print(f"detail cache: {bot_module.detail_cache.stats()}")
+    print(f"discover cache: {bot_module.discover_cache.stats()}")
+
+
+async def main(argv=None) -> None:
+    args = parse_args(argv)
+    upstream = FakeUpstream(latency=args.latency / 1000, jitter=args.jitter,
+                            error_rate=args.error_rate, pages=args.pages, seed=args.seed)
+    await upstream.start()
+
+    with tempfile.TemporaryDirectory(prefix="movie_bot_bench_") as data_dir:
+        configure_env(upstream.url, data_dir)
+        import movie_bot
+
+        session = create_telegram(movie_bot)
+        await movie_bot.on_startup()
+        users = SimulatedUsers(movie_bot, session, args)
+        try:
+            for round_no in range(args.rounds):
+                users.latencies.clear()
+                users.failures = 0
+                upstream.calls.clear()
+                upstream.errors.clear()
+                session.calls.clear()
+                elapsed = await users.run_round(first_chat_id=(round_no + 1) * 1_000_000)
+                report(f"round {round_no + 1}: {args.users} users, concurrency {args.concurrency}, "
+                       f"API latency {args.latency:.0f} ms, errors {args.error_rate:.0%}",
+                       elapsed, users, upstream, session, movie_bot)
+        finally:
+            await movie_bot.on_shutdown()
+            await movie_bot.storage.close()
+            await upstream.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,109 @@
+"""TTL + LRU кеш ответов внешних API"""
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+
+def make_cache_key(source: str, genres: Iterable[Hashable], media_type: Optional[str], page: int = 1) -> Tuple:
+    """Ключ запроса к API по значениям, которые уходят в API (жанры и тип уже
+    переведены в значения источника): порядок и повторы жанров не важны"""
+    return (source, tuple(sorted(set(genres or ()))), media_type or "", int(page))
+
+
+class TTLCache:
+    """Кеш с ограничением по времени жизни записи и по количеству записей (LRU).
+
+    Если задан stale_ttl, просроченная запись ещё столько секунд доступна
+    через lookup() как устаревшая (stale-while-revalidate).
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600, stale_ttl: float = 0,
+                 clock: Callable[[], float] = time.monotonic):
+        if maxsize <= 0:
+            raise ValueError("maxsize должен быть больше нуля")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._clock = clock
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+        # Счётчики
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale_hits = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and entry[0] > self._clock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        value, _ = self._lookup(key, allow_stale=False)
+        return default if value is None else value
+
+    def lookup(self, key: Hashable) -> Tuple[Any, bool]:
+        """Возвращает (значение, устарело ли оно); (None, False) при промахе"""
+        return self._lookup(key, allow_stale=True)
+
+    def _lookup(self, key: Hashable, allow_stale: bool) -> Tuple[Any, bool]:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None, False
+
+        expires_at, value = entry
+        now = self._clock()
+        if expires_at + self.stale_ttl <= now:
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return None, False
+
+        stale = expires_at <= now
+        if stale and not allow_stale:
+            self.misses += 1
+            return None, False
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        if stale:
+            self.stale_hits += 1
+        return value, stale
+
+    def expires_in(self, key: Hashable) -> Optional[float]:
+        """Сколько секунд запись ещё свежая (отрицательно - устарела), None если её нет"""
+        entry = self._data.get(key)
+        return None if entry is None else entry[0] - self._clock()
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at = self._clock() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "stale_hits": self.stale_hits,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
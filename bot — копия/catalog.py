@@ -0,0 +1,265 @@
+"""Локальный каталог фильмов: снимок на диске + инвертированные индексы.
+
+Формат файла снимка:
+    MAGIC (8 байт)
+    длина заголовка (uint32, little-endian)
+    заголовок (JSON): количество записей, индексы значение -> номера строк,
+        смещения столбцов признаков
+    таблица смещений (n + 1 x uint32)
+    столбцы признаков для ранжирования (n значений каждый, little-endian)
+    записи (компактный JSON-массив на запись)
+
+Заголовок, индексы и столбцы признаков читаются при загрузке, записи
+декодируются только по запросу прямо из mmap. Строки упорядочены по
+убыванию рейтинга, поэтому отсортированный результат пересечения уже идёт
+в порядке рейтинга.
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from vocabulary import GENRE_VOCAB, MOOD_VOCAB, TYPE_CODES, UNKNOWN_TYPE_CODE
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"MVCAT\x00\x02\x00"
+# Снимки первой версии (без столбцов признаков) пересобираются при загрузке
+MAGIC_V1 = b"MVCAT\x00\x01\x00"
+
+# Порядок полей записи совпадает с полями MediaItem
+FIELDS = ("id", "title", "original_title", "type", "genres", "mood",
+          "description", "year", "rating", "duration", "poster_url", "source", "votes")
+
+# Поля, по которым строятся инвертированные индексы
+INDEXED_FIELDS = ("genres", "mood", "type", "source")
+
+# Столбцы признаков: имя и формат struct одного значения. Маски - только по
+# фиксированному словарю, их номера битов не зависят от порядка данных
+FEATURE_COLUMNS: Tuple[Tuple[str, str], ...] = (
+    ("genre_mask", "Q"), ("mood_mask", "Q"), ("rating", "f"), ("votes", "f"), ("year", "f"), ("type_code", "b"),
+)
+
+
+def _features(record: Dict) -> Tuple:
+    return (
+        GENRE_VOCAB.fixed_mask(record.get("genres") or ()),
+        MOOD_VOCAB.fixed_mask(record.get("mood") or ()),
+        float(record.get("rating") or 0),
+        float(record.get("votes") or 0),
+        float(record.get("year") or 0),
+        TYPE_CODES.get(record.get("type"), UNKNOWN_TYPE_CODE),
+    )
+
+# Стартовый набор: бывшие local_db и fallback_items Kadikama
+SEED_ITEMS = [
+    {"id": 1, "title": "Начало", "original_title": "Inception", "type": "фильм",
+     "genres": ["фантастика", "триллер"], "mood": ["интеллектуальное", "захватывающее"],
+     "description": "Сны внутри снов...", "year": 2010, "rating": 8.8, "duration": "2ч 28м",
+     "poster_url": None, "source": "local"},
+    {"id": 2, "title": "Побег из Шоушенка", "original_title": "The Shawshank Redemption", "type": "фильм",
+     "genres": ["драма"], "mood": ["вдохновляющее", "грустное"],
+     "description": "История надежды в тюрьме...", "year": 1994, "rating": 9.3, "duration": "2ч 22м",
+     "poster_url": None, "source": "local"},
+    {"id": 3, "title": "Король Лев", "original_title": "The Lion King", "type": "мультфильм",
+     "genres": ["мультфильм", "драма"], "mood": ["трогательное", "вдохновляющее"],
+     "description": "История львёнка Симбы...", "year": 1994, "rating": 8.5, "duration": "1ч 28м",
+     "poster_url": None, "source": "local"},
+    {"id": 4, "title": "Острые козырьки", "original_title": "Peaky Blinders", "type": "сериал",
+     "genres": ["криминал", "драма"], "mood": ["стильное", "захватывающее"],
+     "description": "Британская криминальная сага...", "year": 2013, "rating": 8.8, "duration": "6 сезонов",
+     "poster_url": None, "source": "local"},
+    {"id": 5, "title": "Друзья", "original_title": "Friends", "type": "сериал",
+     "genres": ["комедия"], "mood": ["весёлое", "расслабляющее"],
+     "description": "Жизнь шести друзей в Нью-Йорке...", "year": 1994, "rating": 8.9, "duration": "10 сезонов",
+     "poster_url": None, "source": "local"},
+    {"id": 1001, "title": "Ведьмак", "original_title": "The Witcher", "type": "сериал",
+     "genres": ["фантастика", "приключения", "драма"], "mood": ["захватывающее", "мрачное"],
+     "description": "Геральт из Ривии, мутировавший охотник на чудовищ, путешествует по Континенту.",
+     "year": 2019, "rating": 8.2, "duration": "1 сезон", "poster_url": None, "source": "kadikama"},
+    {"id": 1002, "title": "Игра в кальмара", "original_title": "Squid Game", "type": "сериал",
+     "genres": ["триллер", "драма", "выживание"], "mood": ["страшное", "захватывающее"],
+     "description": "Участники играют в детские игры на выживание ради большого денежного приза.",
+     "year": 2021, "rating": 8.0, "duration": "1 сезон", "poster_url": None, "source": "kadikama"},
+    {"id": 1003, "title": "Энканто", "original_title": "Encanto", "type": "мультфильм",
+     "genres": ["мультфильм", "фэнтези", "мюзикл"], "mood": ["весёлое", "вдохновляющее"],
+     "description": "Магическая история о семье Мадригаль, живущей в волшебном доме в Колумбии.",
+     "year": 2021, "rating": 7.2, "duration": "1ч 42м", "poster_url": None, "source": "kadikama"},
+]
+
+
+def _index_values(record: Dict, field: str) -> Iterable[str]:
+    value = record.get(field)
+    if value is None:
+        return ()
+    if isinstance(value, str):
+        return (value,)
+    return value
+
+
+def build_snapshot(items: Iterable[Dict], path: str) -> int:
+    """Записывает снимок каталога на диск, возвращает количество записей"""
+    records = sorted(items, key=lambda r: r.get("rating") or 0, reverse=True)
+
+    index: Dict[str, Dict[str, List[int]]] = {field: {} for field in INDEXED_FIELDS}
+    payload = bytearray()
+    offsets = array("I", [0])
+    features = []
+    for row, record in enumerate(records):
+        for field in INDEXED_FIELDS:
+            for value in _index_values(record, field):
+                index[field].setdefault(value, []).append(row)
+        payload += json.dumps([record.get(f) for f in FIELDS], ensure_ascii=False,
+                              separators=(",", ":")).encode("utf-8")
+        offsets.append(len(payload))
+        features.append(_features(record))
+
+    # Столбцы идут после таблицы смещений; смещения в заголовке - от её конца
+    columns = bytearray()
+    column_offsets = {}
+    column_values = list(zip(*features)) or [()] * len(FEATURE_COLUMNS)
+    for (name, fmt), values in zip(FEATURE_COLUMNS, column_values):
+        column_offsets[name] = [fmt, len(columns)]
+        columns += struct.pack(f"<{len(values)}{fmt}", *values)
+
+    header = json.dumps({"count": len(records), "fields": FIELDS, "index": index, "columns": column_offsets},
+                        ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if sys.byteorder != "little":
+        offsets.byteswap()
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        f.write(offsets.tobytes())
+        f.write(columns)
+        f.write(payload)
+    os.replace(tmp_path, path)
+    return len(records)
+
+
+class Catalog:
+    """Снимок каталога, загруженный через mmap"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic = self._mm[:len(MAGIC)]
+        if magic not in (MAGIC, MAGIC_V1):
+            self.close()
+            raise ValueError(f"{path}: не похоже на снимок каталога")
+
+        pos = len(MAGIC)
+        (header_len,) = struct.unpack_from("<I", self._mm, pos)
+        pos += 4
+        header = json.loads(self._mm[pos:pos + header_len].decode("utf-8"))
+        pos += header_len
+
+        self.count: int = header["count"]
+        self._fields = tuple(header["fields"])
+        self._index: Dict[str, Dict[str, FrozenSet[int]]] = {
+            field: {value: frozenset(rows) for value, rows in values.items()}
+            for field, values in header["index"].items()
+        }
+
+        self._offsets = array("I")
+        self._offsets.frombytes(self._mm[pos:pos + 4 * (self.count + 1)])
+        if sys.byteorder != "little":
+            self._offsets.byteswap()
+        pos += 4 * (self.count + 1)
+        # Снимок первой версии: столбцов нет, записи сразу после смещений
+        self._columns: Dict[str, Tuple[str, int]] = {
+            name: (fmt, pos + offset) for name, (fmt, offset) in header.get("columns", {}).items()
+        }
+        self._data_start = pos + sum(struct.calcsize(fmt) * self.count for fmt, _ in self._columns.values())
+
+    @property
+    def has_features(self) -> bool:
+        return all(name in self._columns for name, _ in FEATURE_COLUMNS)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self) -> None:
+        self._mm.close()
+        self._file.close()
+
+    def record(self, row: int) -> Dict:
+        """Запись по номеру строки, декодируется из mmap при каждом вызове"""
+        start = self._data_start + self._offsets[row]
+        end = self._data_start + self._offsets[row + 1]
+        values = json.loads(self._mm[start:end].decode("utf-8"))
+        return dict(zip(self._fields, values))
+
+    def column(self, name: str) -> Tuple[str, bytes]:
+        """Столбец признаков: формат struct значения и сырые байты (little-endian)"""
+        fmt, start = self._columns[name]
+        return fmt, self._mm[start:start + struct.calcsize(fmt) * self.count]
+
+    def rows(self, field: str, value: str) -> FrozenSet[int]:
+        return self._index.get(field, {}).get(value, frozenset())
+
+    def values(self, field: str) -> List[str]:
+        return list(self._index.get(field, {}))
+
+    def query(self, genres: Optional[Iterable[str]] = None, moods: Optional[Iterable[str]] = None,
+              media_type: Optional[str] = None, source: Optional[str] = None) -> List[int]:
+        """Номера строк, подходящих под фильтры, в порядке рейтинга.
+
+        Внутри жанров и настроений достаточно одного совпадения,
+        между фильтрами - пересечение.
+        """
+        result: Optional[FrozenSet[int]] = None
+
+        def narrow(current, rows):
+            return rows if current is None else current & rows
+
+        if source:
+            result = narrow(result, self.rows("source", source))
+        if media_type and media_type != "любой":
+            result = narrow(result, self.rows("type", media_type))
+        if genres:
+            result = narrow(result, frozenset().union(*(self.rows("genres", g) for g in genres)))
+        if moods:
+            result = narrow(result, frozenset().union(*(self.rows("mood", m) for m in moods)))
+
+        if result is None:
+            return list(range(self.count))
+        return sorted(result)
+
+    def records(self, rows: Iterable[int]) -> List[Dict]:
+        return [self.record(row) for row in rows]
+
+
+def load_catalog(path: str) -> Catalog:
+    """Загружает снимок, при отсутствии создаёт его из стартового набора"""
+    if not os.path.exists(path):
+        count = build_snapshot(SEED_ITEMS, path)
+        logger.info(f"Catalog snapshot created: {path} ({count} items)")
+    catalog = Catalog(path)
+    if not catalog.has_features:
+        records = catalog.records(range(len(catalog)))
+        catalog.close()
+        build_snapshot(records, path)
+        logger.info(f"Catalog snapshot upgraded with feature columns: {path}")
+        catalog = Catalog(path)
+    logger.info(f"Catalog loaded: {path} ({len(catalog)} items)")
+    return catalog
+
+
+if __name__ == "__main__":
+    # python catalog.py items.json catalog.bin - собрать снимок из JSON-списка записей
+    if len(sys.argv) != 3:
+        print("Использование: python catalog.py <items.json> <catalog.bin>")
+        sys.exit(1)
+    with open(sys.argv[1], encoding="utf-8") as f:
+        items = json.load(f)
+    print(f"Записано {build_snapshot(items, sys.argv[2])} записей в {sys.argv[2]}")
@@ -0,0 +1,135 @@
+"""Сопоставление одних и тех же фильмов из разных источников.
+
+Индекс связывает ссылки 'source:id' (TMDB, Кинопоиск, локальный каталог)
+с общим номером сущности. Новые ссылки сопоставляются по нормализованному
+оригинальному названию и году, затем по локализованному названию и году.
+Всё хранится в памяти (поиск - несколько обращений к словарю) и
+дописывается в SQLite, поэтому индекс пополняется между перезапусками.
+Файл могут делить несколько процессов: при промахе в памяти связь ищется
+в базе, а номера новых сущностей выдаёт SQLite.
+"""
+import logging
+import re
+import unicodedata
+from typing import Dict, Iterable, List, Optional
+
+from sqlite_db import connect
+
+logger = logging.getLogger(__name__)
+
+_NON_WORD = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def normalize_title(title: Optional[str]) -> str:
+    if not title:
+        return ""
+    title = unicodedata.normalize("NFKC", title).casefold().replace("ё", "е")
+    return _NON_WORD.sub(" ", title).strip()
+
+
+def _title_keys(item) -> List[str]:
+    """Ключи сопоставления: оригинальное название важнее локализованного"""
+    keys = []
+    for prefix, title in (("o", item.original_title), ("t", item.title)):
+        normalized = normalize_title(title)
+        if normalized and item.year:
+            keys.append(f"{prefix}:{normalized}:{item.year}")
+    return keys
+
+
+class EntityIndex:
+    def __init__(self, path: Optional[str] = None):
+        self._by_ref: Dict[str, int] = {}
+        self._by_key: Dict[str, int] = {}
+        self._refs_by_entity: Dict[int, List[str]] = {}
+        self._next_id = 1
+        self._db = None
+        if path:
+            self._db = connect(path)
+            self._db.execute("CREATE TABLE IF NOT EXISTS refs (ref TEXT PRIMARY KEY, entity INTEGER NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY, entity INTEGER NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS entities (id INTEGER PRIMARY KEY)")
+            self._by_ref = dict(self._db.execute("SELECT ref, entity FROM refs"))
+            self._by_key = dict(self._db.execute("SELECT key, entity FROM keys"))
+            self._next_id = max(list(self._by_ref.values()) + list(self._by_key.values()) + [0]) + 1
+            # Индексы, созданные до таблицы entities: номера продолжают существующие
+            if self._next_id > 1:
+                self._db.execute("INSERT OR IGNORE INTO entities (id) VALUES (?)", (self._next_id - 1,))
+            for item_ref, entity in self._by_ref.items():
+                self._refs_by_entity.setdefault(entity, []).append(item_ref)
+            logger.info(f"Entity index loaded: {len(self._by_ref)} refs, {self._next_id - 1} entities")
+
+    def __len__(self) -> int:
+        return len(self._by_ref)
+
+    def entity(self, ref: str) -> Optional[int]:
+        return self._by_ref.get(ref)
+
+    def refs(self, entity: int) -> List[str]:
+        """Все известные ссылки сущности (во всех источниках)"""
+        return self._refs_by_entity.get(entity, [])
+
+    def _stored_entity(self, table: str, column: str, value: str) -> Optional[int]:
+        """Связь, которую записал другой процесс; подгружает ссылки сущности в память"""
+        if not self._db:
+            return None
+        row = self._db.execute(f"SELECT entity FROM {table} WHERE {column} = ?", (value,)).fetchone()
+        if row is None:
+            return None
+        entity = row[0]
+        refs = self._refs_by_entity.setdefault(entity, [])
+        for (item_ref,) in self._db.execute("SELECT ref FROM refs WHERE entity = ?", (entity,)):
+            if item_ref not in self._by_ref:
+                self._by_ref[item_ref] = entity
+                refs.append(item_ref)
+        return entity
+
+    def _new_entity(self) -> int:
+        if self._db:
+            return self._db.execute("INSERT INTO entities (id) VALUES (NULL)").lastrowid
+        entity = self._next_id
+        self._next_id += 1
+        return entity
+
+    def resolve_many(self, items: Iterable, ref=lambda item: f"{item.source}:{item.id}") -> List[int]:
+        """Номера сущностей для карточек; новые связи сохраняются"""
+        new_refs, new_keys = [], []
+        entities = []
+        for item in items:
+            item_ref = ref(item)
+            entity = self._by_ref.get(item_ref)
+            if entity is None:
+                entity = self._stored_entity("refs", "ref", item_ref)
+            keys = _title_keys(item)
+
+            if entity is None:
+                source = item_ref.split(":", 1)[0]
+                for key in keys:
+                    entity = self._by_key.get(key)
+                    if entity is None:
+                        entity = self._stored_entity("keys", "key", key)
+                    # Две разные карточки одного источника - разные фильмы
+                    if entity is not None and not any(
+                            r.startswith(source + ":") for r in self._refs_by_entity.get(entity, ())):
+                        break
+                    entity = None
+                if entity is None:
+                    entity = self._new_entity()
+                self._by_ref[item_ref] = entity
+                self._refs_by_entity.setdefault(entity, []).append(item_ref)
+                new_refs.append((item_ref, entity))
+
+            for key in keys:
+                if key not in self._by_key:
+                    self._by_key[key] = entity
+                    new_keys.append((key, entity))
+            entities.append(entity)
+
+        if self._db and (new_refs or new_keys):
+            self._db.executemany("INSERT OR REPLACE INTO refs (ref, entity) VALUES (?, ?)", new_refs)
+            self._db.executemany("INSERT OR IGNORE INTO keys (key, entity) VALUES (?, ?)", new_keys)
+        return entities
+
+    def close(self) -> None:
+        if self._db:
+            self._db.close()
@@ -0,0 +1,163 @@
+"""Постоянное хранилище FSM и общий кеш карточек фильмов"""
+import json
+import logging
+import time
+import zlib
+from typing import Any, Callable, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from cache import TTLCache
+from sqlite_db import connect
+
+logger = logging.getLogger(__name__)
+
+# Данные сессии крупнее этого размера сжимаются
+COMPRESS_THRESHOLD = 512
+
+
+def encode_data(data: Mapping[str, Any]) -> bytes:
+    """Компактная кодировка данных сессии: JSON без пробелов, крупное - через zlib"""
+    raw = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(raw) > COMPRESS_THRESHOLD:
+        return b"z" + zlib.compress(raw)
+    return b"j" + raw
+
+
+def decode_data(blob: Optional[bytes]) -> Dict[str, Any]:
+    if not blob:
+        return {}
+    kind, payload = blob[:1], blob[1:]
+    if kind == b"z":
+        payload = zlib.decompress(payload)
+    return json.loads(payload.decode("utf-8"))
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в SQLite (WAL).
+
+    Состояние и данные пользователя лежат в одной строке; сессии, к которым
+    не обращались дольше ttl секунд, считаются пустыми и удаляются
+    методом expire(). Запросы короткие и идут к локальному файлу, поэтому
+    выполняются прямо в цикле событий.
+    """
+
+    def __init__(self, path: str, ttl: Optional[float] = None):
+        self.path = path
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._db = connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS fsm ("
+            " key TEXT PRIMARY KEY,"
+            " state TEXT,"
+            " data BLOB,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS fsm_updated_at ON fsm(updated_at)")
+
+    def _row(self, key: StorageKey):
+        row = self._db.execute(
+            "SELECT state, data, updated_at FROM fsm WHERE key = ?",
+            (self.key_builder.build(key),)
+        ).fetchone()
+        if row is None or (self.ttl and row[2] < time.time() - self.ttl):
+            return None, None
+        return row[0], row[1]
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        self._db.execute(
+            "INSERT INTO fsm (key, state, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+            (self.key_builder.build(key), value, time.time())
+        )
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._row(key)[0]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        self._db.execute(
+            "INSERT INTO fsm (key, data, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            (self.key_builder.build(key), encode_data(data) if data else None, time.time())
+        )
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return decode_data(self._row(key)[1])
+
+    def expire(self) -> int:
+        """Удаляет сессии, простаивающие дольше ttl; возвращает их количество"""
+        if not self.ttl:
+            return 0
+        cursor = self._db.execute("DELETE FROM fsm WHERE updated_at < ?", (time.time() - self.ttl,))
+        return cursor.rowcount
+
+    def count(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM fsm WHERE state IS NOT NULL").fetchone()[0]
+
+    async def close(self) -> None:
+        self._db.close()
+
+
+def create_storage(url: str, ttl: Optional[float] = None) -> BaseStorage:
+    """Хранилище FSM по адресу: memory://, sqlite:///путь или redis://..."""
+    if url.startswith("sqlite:///"):
+        return SQLiteStorage(url[len("sqlite:///"):], ttl=ttl)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError as e:
+            raise ValueError("Для FSM_STORAGE=redis нужен пакет redis") from e
+        return RedisStorage.from_url(url, state_ttl=ttl, data_ttl=ttl)
+    if url in ("memory", "memory://"):
+        return MemoryStorage()
+    raise ValueError(f"Неизвестное хранилище FSM: {url}")
+
+
+class ItemStore:
+    """Общий для всех пользователей кеш по ссылке вида 'source:id'.
+
+    Горячие значения лежат в памяти (LRU), все - в таблице SQLite, поэтому
+    сессии хранят только ссылки и переживают перезапуск. Значения
+    сохраняются как JSON от encode(value); по умолчанию - как есть.
+    """
+
+    def __init__(self, path: Optional[str], encode: Callable[[Any], Any] = lambda value: value,
+                 decode: Callable[[Any], Any] = lambda value: value, maxsize: int = 10000,
+                 table: str = "items"):
+        self._encode = encode
+        self._decode = decode
+        self._table = table
+        self._memory = TTLCache(maxsize=maxsize, ttl=float("inf"))
+        self._db = None
+        if path:
+            self._db = connect(path)
+            self._db.execute(f"CREATE TABLE IF NOT EXISTS {table} (ref TEXT PRIMARY KEY, data TEXT NOT NULL)")
+
+    def put_many(self, items: Mapping[str, Any]) -> None:
+        for ref, item in items.items():
+            self._memory.set(ref, item)
+        if self._db and items:
+            self._db.executemany(
+                f"INSERT OR REPLACE INTO {self._table} (ref, data) VALUES (?, ?)",
+                [(ref, json.dumps(self._encode(item), ensure_ascii=False, separators=(",", ":")))
+                 for ref, item in items.items()]
+            )
+
+    def get(self, ref: str) -> Optional[Any]:
+        item = self._memory.get(ref)
+        if item is not None or self._db is None:
+            return item
+        row = self._db.execute(f"SELECT data FROM {self._table} WHERE ref = ?", (ref,)).fetchone()
+        if row is None:
+            return None
+        item = self._decode(json.loads(row[0]))
+        self._memory.set(ref, item)
+        return item
+
+    def close(self) -> None:
+        if self._db:
+            self._db.close()
@@ -0,0 +1,117 @@
+"""История пользователя: что он уже видел, отклонил или выбрал.
+
+События дописываются в SQLite (только вставки), а для фильтрации
+кандидатов у каждого пользователя есть фильтр Блума по ссылкам
+'source:id': проверка кандидата - несколько обращений к битовому массиву,
+сколько бы событий ни накопилось. Ложные срабатывания возможны
+(по умолчанию ~1%) - такой кандидат просто не будет предложен.
+"""
+import hashlib
+import math
+import time
+from typing import Iterable, Optional
+
+from cache import TTLCache
+from sqlite_db import connect
+
+SEEN = "seen"
+REJECTED = "rejected"
+CHOSEN = "chosen"
+
+
+class BloomFilter:
+    """Фильтр Блума на bytearray с двойным хешированием"""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.size = max(8, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value: str):
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, value: str) -> None:
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+    @property
+    def full(self) -> bool:
+        return self.count > self.capacity
+
+
+class UserHistory:
+    """Журнал событий по пользователям и фильтры Блума для горячих пользователей.
+
+    Фильтр пользователя строится из журнала при первом обращении и
+    пересобирается в несколько раз большим, когда событий становится
+    больше расчётной ёмкости (иначе растёт доля ложных срабатываний).
+    """
+
+    def __init__(self, path: Optional[str] = None, max_users: int = 10000,
+                 initial_capacity: int = 256, error_rate: float = 0.01):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self._filters = TTLCache(maxsize=max_users, ttl=float("inf"))
+        self._db = None
+        if path:
+            self._db = connect(path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS history ("
+                " user_id INTEGER NOT NULL,"
+                " ref TEXT NOT NULL,"
+                " event TEXT NOT NULL,"
+                " at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS history_user ON history(user_id)")
+
+    def _load(self, user_id: int, capacity: int) -> BloomFilter:
+        refs = []
+        if self._db:
+            rows = self._db.execute("SELECT ref FROM history WHERE user_id = ?", (user_id,))
+            refs = list(dict.fromkeys(row[0] for row in rows))
+        while capacity < len(refs):
+            capacity *= 4
+        bloom = BloomFilter(capacity, self.error_rate)
+        for ref in refs:
+            bloom.add(ref)
+        self._filters.set(user_id, bloom)
+        return bloom
+
+    def filter(self, user_id: int) -> BloomFilter:
+        """Фильтр всего, что пользователь уже видел, отклонил или выбрал"""
+        bloom = self._filters.get(user_id)
+        if bloom is None:
+            bloom = self._load(user_id, self.initial_capacity)
+        return bloom
+
+    def record(self, user_id: int, event: str, refs: Iterable[str]) -> None:
+        """Добавляет событие; refs - ссылки на карточку во всех известных источниках"""
+        refs = list(dict.fromkeys(refs))
+        bloom = self.filter(user_id)
+        new_refs = [ref for ref in refs if ref not in bloom]
+        for ref in new_refs:
+            bloom.add(ref)
+
+        if self._db and refs:
+            now = time.time()
+            self._db.executemany(
+                "INSERT INTO history (user_id, ref, event, at) VALUES (?, ?, ?, ?)",
+                [(user_id, ref, event, now) for ref in refs]
+            )
+        if bloom.full and self._db:
+            self._load(user_id, bloom.capacity * 4)
+
+    def close(self) -> None:
+        if self._db:
+            self._db.close()
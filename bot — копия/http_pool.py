@@ -0,0 +1,97 @@
+"""Пул HTTP-соединений к внешним API"""
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class PoolConfig:
+    """Настройки пула соединений и таймаутов"""
+    limit: int = 100                  # всего соединений
+    limit_per_host: int = 20          # соединений на один хост
+    ttl_dns_cache: int = 300          # секунд хранить DNS-ответы
+    keepalive_timeout: float = 30.0   # секунд держать простаивающее соединение
+    total_timeout: float = 10.0       # общий таймаут запроса
+    connect_timeout: float = 3.0      # получение соединения из пула + подключение
+    sock_connect_timeout: float = 3.0 # TCP/TLS подключение
+    sock_read_timeout: float = 5.0    # пауза между кусками ответа
+
+    @classmethod
+    def from_env(cls) -> "PoolConfig":
+        return cls(
+            limit=int(os.getenv('HTTP_POOL_LIMIT', cls.limit)),
+            limit_per_host=int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', cls.limit_per_host)),
+            ttl_dns_cache=int(os.getenv('HTTP_DNS_CACHE_TTL', cls.ttl_dns_cache)),
+            keepalive_timeout=float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', cls.keepalive_timeout)),
+            total_timeout=float(os.getenv('HTTP_TOTAL_TIMEOUT', cls.total_timeout)),
+            connect_timeout=float(os.getenv('HTTP_CONNECT_TIMEOUT', cls.connect_timeout)),
+            sock_connect_timeout=float(os.getenv('HTTP_SOCK_CONNECT_TIMEOUT', cls.sock_connect_timeout)),
+            sock_read_timeout=float(os.getenv('HTTP_SOCK_READ_TIMEOUT', cls.sock_read_timeout)),
+        )
+
+
+class SessionPool:
+    """Одна общая aiohttp-сессия с настроенным коннектором.
+
+    Создаётся лениво под блокировкой, поэтому одновременные обработчики
+    не откроют две сессии.
+    """
+
+    def __init__(self, config: Optional[PoolConfig] = None):
+        self.config = config or PoolConfig()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def closed(self) -> bool:
+        return self._session is None or self._session.closed
+
+    async def get(self) -> aiohttp.ClientSession:
+        if not self.closed:
+            return self._session
+
+        async with self._lock:
+            if self.closed:
+                self._session = self._create_session()
+                logger.info(
+                    f"HTTP pool opened: limit={self.config.limit}, "
+                    f"per_host={self.config.limit_per_host}"
+                )
+            return self._session
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        config = self.config
+        connector = aiohttp.TCPConnector(
+            limit=config.limit,
+            limit_per_host=config.limit_per_host,
+            ttl_dns_cache=config.ttl_dns_cache,
+            use_dns_cache=True,
+            keepalive_timeout=config.keepalive_timeout,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=config.total_timeout,
+            connect=config.connect_timeout,
+            sock_connect=config.sock_connect_timeout,
+            sock_read=config.sock_read_timeout,
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            headers={"Accept-Encoding": "gzip, deflate"},
+            auto_decompress=True,
+        )
+
+    async def close(self) -> None:
+        async with self._lock:
+            if self._session is not None and not self._session.closed:
+                await self._session.close()
+                # Даём коннектору закрыть SSL-соединения
+                await asyncio.sleep(0.25)
+                logger.info("HTTP pool closed")
+            self._session = None
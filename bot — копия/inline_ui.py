@@ -0,0 +1,104 @@
+"""Интерфейс на inline-кнопках: одно сообщение, которое правится на каждом шаге.
+
+Выбор жанров и настроений хранится не в FSM, а в callback_data кнопок:
+маска выбранных значений (бит i - i-е значение словаря) в шестнадцатеричном
+виде. Нажатие переключает бит, и бот только заменяет клавиатуру
+сообщения; в FSM выбор попадает один раз - когда выбран тип.
+
+    g:<жанры>            переключить жанр      G:<жанры>          готово
+    m:<жанры>:<настр.>   переключить настр.    M:<жанры>:<настр.> готово
+    t:<жанры>:<настр.>:<номер типа>
+    r:<w|n|y|x>          реакция на карточку
+"""
+from functools import lru_cache
+from typing import List, Optional, Sequence, Tuple
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from vocabulary import (
+    DONE_BUTTON, GENRES, MEDIA_TYPES, MOODS, NEXT_BUTTON, RESTART_NO_BUTTON, RESTART_YES_BUTTON,
+    WATCH_BUTTON,
+)
+
+GENRE = "g"
+GENRES_DONE = "G"
+MOOD = "m"
+MOOD_DONE = "M"
+TYPE = "t"
+REACTION = "r"
+
+# Реакции кнопками -> тексты кнопок обычной клавиатуры (обработчики общие)
+REACTIONS = {"w": WATCH_BUTTON, "n": NEXT_BUTTON, "y": RESTART_YES_BUTTON, "x": RESTART_NO_BUTTON}
+
+_FIELDS = {GENRE: 1, GENRES_DONE: 1, MOOD: 2, MOOD_DONE: 2, TYPE: 3}
+_LIMITS = (1 << len(GENRES), 1 << len(MOODS), len(MEDIA_TYPES))
+
+
+def encode(prefix: str, *values: int) -> str:
+    return ":".join([prefix] + [f"{value:x}" for value in values])
+
+
+def decode(data: Optional[str]) -> Optional[Tuple[str, List[int]]]:
+    """callback_data шага выбора -> (префикс, числа); None - если данные не наши"""
+    prefix, _, rest = (data or "").partition(":")
+    if prefix not in _FIELDS:
+        return None
+    try:
+        values = [int(part, 16) for part in rest.split(":")]
+    except ValueError:
+        return None
+    if len(values) != _FIELDS[prefix] or any(not 0 <= v < limit for v, limit in zip(values, _LIMITS)):
+        return None
+    return prefix, values
+
+
+def selected(mask: int, names: Sequence[str]) -> List[str]:
+    return [name for i, name in enumerate(names) if mask >> i & 1]
+
+
+def _toggle_rows(names: Sequence[str], mask: int, data, done_data: str) -> List[List[InlineKeyboardButton]]:
+    buttons = [
+        InlineKeyboardButton(text=f"✅ {name}" if mask >> i & 1 else name, callback_data=data(mask ^ 1 << i))
+        for i, name in enumerate(names)
+    ]
+    rows = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+    rows.append([InlineKeyboardButton(text=DONE_BUTTON, callback_data=done_data)])
+    return rows
+
+
+# Клавиатуры зависят только от масок - одинаковые не собираются заново
+@lru_cache(maxsize=1024)
+def genres_keyboard(genre_mask: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=_toggle_rows(
+        GENRES, genre_mask, lambda mask: encode(GENRE, mask), encode(GENRES_DONE, genre_mask)
+    ))
+
+
+@lru_cache(maxsize=1024)
+def mood_keyboard(genre_mask: int, mood_mask: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=_toggle_rows(
+        MOODS, mood_mask, lambda mask: encode(MOOD, genre_mask, mask), encode(MOOD_DONE, genre_mask, mood_mask)
+    ))
+
+
+@lru_cache(maxsize=1024)
+def type_keyboard(genre_mask: int, mood_mask: int) -> InlineKeyboardMarkup:
+    buttons = [InlineKeyboardButton(text=name, callback_data=encode(TYPE, genre_mask, mood_mask, i))
+               for i, name in enumerate(MEDIA_TYPES)]
+    return InlineKeyboardMarkup(inline_keyboard=[buttons[i:i + 3] for i in range(0, len(buttons), 3)])
+
+
+def _reaction_keyboard(*codes: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=REACTIONS[code], callback_data=f"{REACTION}:{code}")] for code in codes
+    ])
+
+
+REACTION_KEYBOARD = _reaction_keyboard("w", "n")
+CONFIRM_RESTART_KEYBOARD = _reaction_keyboard("y", "x")
+
+
+def reaction(data: Optional[str]) -> Optional[str]:
+    """callback_data реакции -> текст соответствующей кнопки"""
+    prefix, _, code = (data or "").partition(":")
+    return REACTIONS.get(code) if prefix == REACTION else None
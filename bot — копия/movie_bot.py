@@ -4,11 +4,40 @@ import logging
 import aiohttp
 import random
 import os
-from typing import Dict, List, Optional
-from dataclasses import dataclass
+import secrets
+import signal
+import sys
+import time
+from typing import Any, AsyncIterator, Awaitable, Dict, List, Optional, Tuple
 from datetime import datetime
 from dotenv import load_dotenv
 
+from cache import TTLCache, make_cache_key
+from catalog import load_catalog
+from entity_index import EntityIndex
+from fsm_storage import ItemStore, create_storage
+from history import CHOSEN, REJECTED, SEEN, BloomFilter, UserHistory
+from http_pool import PoolConfig, SessionPool
+import inline_ui
+from metrics import Registry, monitor_loop_lag, start_metrics_server, timed
+from outbox import SendLimiter
+from posters import PosterPipeline
+from prefetch import CachePrefetcher
+from ranking import FeatureMatrix, RankingWeights, RankQuery, best_candidate, rank_items
+from ratelimit import ProviderLimiter, QuotaStore
+from resilience import CircuitBreaker, RetryPolicy
+from shared_cache import create_shared_cache
+from singleflight import SingleFlight
+from trending import MOVIE, TV, TrendingBoard, parse_trending_args
+from vocabulary import (
+    CONFIRM_RESTART_KEYBOARD, DONE_BUTTON, GENRE_ADDED, GENRE_REMOVED, GENRE_SET, GENRE_VOCAB, GENRES,
+    GENRES_DONE_TEMPLATE, GENRES_KEYBOARD, MEDIA_TYPE_SET, MEDIA_TYPES, MOOD_ADDED, MOOD_DONE_TEMPLATE,
+    MOOD_KEYBOARD, MOOD_REMOVED, MOOD_SET, MOOD_VOCAB, MOODS, NEXT_BUTTON, REACTION_KEYBOARD, REMOVE_KEYBOARD,
+    RESTART_NO_BUTTON, RESTART_YES_BUTTON, SELECTED_TEMPLATE, SOURCE_EMOJI, SUMMARY_TEMPLATE,
+    TYPE_EMOJI, TYPE_KEYBOARD, WATCH_BUTTON,
+)
+from workers import UpdateRouter, spawn_workers, stop_workers
+
 # Загружаем переменные окружения из .env файла
 load_dotenv()
 
@@ -28,6 +57,7 @@ API_CONFIG = {
     # TMDB API
     "tmdb_api_key": os.getenv('TMDB_API_KEY'),
     "tmdb_base_url": os.getenv('TMDB_BASE_URL', 'https://api.themoviedb.org/3'),
+    "tmdb_image_base_url": os.getenv('TMDB_IMAGE_BASE_URL', 'https://image.tmdb.org/t/p/w500'),
     
     # Кинопоиск API
     "kinopoisk_api_key": os.getenv('KINOPOISK_API_KEY'),
@@ -43,86 +73,436 @@ if not API_CONFIG["tmdb_api_key"]:
 
 # Настройки бота
 CACHE_DURATION = int(os.getenv('CACHE_DURATION', 3600))
+CACHE_MAX_SIZE = int(os.getenv('CACHE_MAX_SIZE', 2048))
+# Сколько секунд после истечения TTL отдавать устаревший ответ, пока он обновляется
+CACHE_STALE_DURATION = int(os.getenv('CACHE_STALE_DURATION', CACHE_DURATION))
+DETAIL_CACHE_DURATION = int(os.getenv('DETAIL_CACHE_DURATION', 86400))
+DETAIL_CACHE_MAX_SIZE = int(os.getenv('DETAIL_CACHE_MAX_SIZE', 10000))
+TMDB_DETAIL_CONCURRENCY = int(os.getenv('TMDB_DETAIL_CONCURRENCY', 10))
+
+# Фоновый прогрев кеша
+PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', '1') == '1'
+PREFETCH_INTERVAL = float(os.getenv('PREFETCH_INTERVAL', CACHE_DURATION * 0.8))
+PREFETCH_RATE = float(os.getenv('PREFETCH_RATE', 2.0))  # запросов в секунду
+PREFETCH_JITTER = float(os.getenv('PREFETCH_JITTER', 0.5))
+PREFETCH_POPULAR_KEYS = int(os.getenv('PREFETCH_POPULAR_KEYS', 50))
+
+# Постеры: карточки отправляются фото, file_id загруженных постеров переиспользуются
+POSTERS_ENABLED = os.getenv('POSTERS_ENABLED', '1') == '1'
+POSTER_MAX_SIDE = int(os.getenv('POSTER_MAX_SIDE', 0))  # уменьшать крупнее (нужен Pillow); 0 - как есть
+CAPTION_LIMIT = 1024  # лимит Telegram на подпись к фото
+
+# /trending: фоновое обновление готовых сообщений
+TRENDING_INTERVAL = float(os.getenv('TRENDING_INTERVAL', 3600))
+TRENDING_RETRY_INTERVAL = float(os.getenv('TRENDING_RETRY_INTERVAL', 300))  # после неудачного обновления
+TRENDING_LIMIT = int(os.getenv('TRENDING_LIMIT', 5))
+
+# Локальные данные
+DATA_DIR = os.getenv('DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+CATALOG_PATH = os.getenv('CATALOG_PATH', os.path.join(DATA_DIR, 'catalog.bin'))
+# Сколько карточек каталога держать в памяти (остальные читаются из снимка)
+CATALOG_ITEM_CACHE_SIZE = int(os.getenv('CATALOG_ITEM_CACHE_SIZE', 5000))
+os.makedirs(DATA_DIR, exist_ok=True)
+
+# Несколько процессов: при WORKERS > 1 этот процесс только раздаёт обновления
+# обработчикам (копиям бота с WORKER_ID) по chat_id
+WORKERS = int(os.getenv('WORKERS', 1))
+WORKER_ID = int(os.getenv('WORKER_ID')) if os.getenv('WORKER_ID') else None
+WORKER_HOST = os.getenv('WORKER_HOST', '127.0.0.1')
+WORKER_BASE_PORT = int(os.getenv('WORKER_BASE_PORT', 8100))
+# Общий для процессов кеш ответов API: sqlite:///путь или redis://... (пусто - только память)
+SHARED_CACHE = os.getenv('SHARED_CACHE', '')
+
+# Хранилище FSM: memory://, sqlite:///путь или redis://...
+FSM_STORAGE = os.getenv('FSM_STORAGE', f"sqlite:///{os.path.join(DATA_DIR, 'fsm.db')}")
+FSM_SESSION_TTL = int(os.getenv('FSM_SESSION_TTL', 7 * 86400))  # простаивающие сессии удаляются
+FSM_CLEANUP_INTERVAL = float(os.getenv('FSM_CLEANUP_INTERVAL', 3600))
+ITEM_STORE_PATH = os.getenv('ITEM_STORE_PATH', os.path.join(DATA_DIR, 'items.db'))
+ITEM_STORE_MAX_SIZE = int(os.getenv('ITEM_STORE_MAX_SIZE', 10000))
+POSTER_STORE_PATH = os.getenv('POSTER_STORE_PATH', os.path.join(DATA_DIR, 'posters.db'))
+ENTITY_INDEX_PATH = os.getenv('ENTITY_INDEX_PATH', os.path.join(DATA_DIR, 'entities.db'))
+# История показов и выборов: уже виденное больше не предлагается
+TRENDING_PATH = os.getenv('TRENDING_PATH', os.path.join(DATA_DIR, 'trending.json'))
+HISTORY_PATH = os.getenv('HISTORY_PATH', os.path.join(DATA_DIR, 'history.db'))
+HISTORY_MAX_USERS = int(os.getenv('HISTORY_MAX_USERS', 10000))  # фильтров в памяти
+
+# Если каталог нашёл столько вариантов, внешние API не опрашиваются
+LOCAL_CATALOG_MIN_RESULTS = int(os.getenv('LOCAL_CATALOG_MIN_RESULTS', 10))
+
+# Лимиты запросов к API: запросов в секунду, запас, дневная квота (0 - без квоты)
+QUOTA_STATE_PATH = os.getenv('QUOTA_STATE_PATH', os.path.join(
+    DATA_DIR, 'quota.json' if WORKER_ID is None else f'quota.{WORKER_ID}.json'
+))
+RATE_LIMITS = {
+    "tmdb": {
+        "rate": float(os.getenv('TMDB_RATE_LIMIT', 20)),
+        "burst": float(os.getenv('TMDB_RATE_BURST', 20)),
+        "daily_quota": int(os.getenv('TMDB_DAILY_QUOTA', 0)),
+    },
+    "kinopoisk": {
+        "rate": float(os.getenv('KINOPOISK_RATE_LIMIT', 5)),
+        "burst": float(os.getenv('KINOPOISK_RATE_BURST', 5)),
+        "daily_quota": int(os.getenv('KINOPOISK_DAILY_QUOTA', 200)),
+    },
+}
+# Сколько максимум ждать свободный токен, прежде чем отдать кеш/локальные данные
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', 1.0))
+
+# Исходящие сообщения Telegram: не чаще лимитов Bot API (0 - без ограничения)
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', 1.0))  # в личный чат, сообщений в секунду
+TELEGRAM_CHAT_BURST = float(os.getenv('TELEGRAM_CHAT_BURST', 3))
+TELEGRAM_GROUP_RATE = float(os.getenv('TELEGRAM_GROUP_RATE', 20 / 60))
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 30))  # на бота, делится между процессами
+TELEGRAM_FLOOD_RETRIES = int(os.getenv('TELEGRAM_FLOOD_RETRIES', 3))
+# Доля дневной квоты, которую фоновый прогрев не трогает
+PREFETCH_QUOTA_RESERVE = float(os.getenv('PREFETCH_QUOTA_RESERVE', 0.5))
+
+# Повторы запросов и отключение недоступного провайдера
+API_RETRY_ATTEMPTS = int(os.getenv('API_RETRY_ATTEMPTS', 3))
+API_RETRY_BASE_DELAY = float(os.getenv('API_RETRY_BASE_DELAY', 0.2))
+API_RETRY_MAX_DELAY = float(os.getenv('API_RETRY_MAX_DELAY', 2.0))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_COOLDOWN = float(os.getenv('CIRCUIT_COOLDOWN', 30))
+
+# Ранжирование рекомендаций
+RECOMMENDATIONS_LIMIT = int(os.getenv('RECOMMENDATIONS_LIMIT', 10))
+RANKING_WEIGHTS = {
+    "genre": float(os.getenv('RANK_WEIGHT_GENRE', 3.0)),
+    "mood": float(os.getenv('RANK_WEIGHT_MOOD', 2.0)),
+    "type": float(os.getenv('RANK_WEIGHT_TYPE', 1.5)),
+    "rating": float(os.getenv('RANK_WEIGHT_RATING', 1.0)),
+    "votes": float(os.getenv('RANK_WEIGHT_VOTES', 0.5)),
+    "recency": float(os.getenv('RANK_WEIGHT_RECENCY', 0.5)),
+}
+
+# Ленивая подгрузка: сколько карточек запрашивается у источника за раз и когда
+# (сколько непоказанных осталось в очереди) подгружать следующую страницу
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 5))
+PAGING_PREFETCH_AHEAD = int(os.getenv('PAGING_PREFETCH_AHEAD', 3))
+PAGING_MAX_PAGE = int(os.getenv('PAGING_MAX_PAGE', 50))
+TMDB_PAGE_SIZE = 20  # фиксированный размер страницы discover
+PAGED_SOURCES = ("tmdb", "kinopoisk")
+
+# Первая рекомендация показывается сразу, если её оценка (доля от максимальной) не ниже порога
+FIRST_RESULT_MIN_SCORE = float(os.getenv('FIRST_RESULT_MIN_SCORE', 0.6))
+
+# Дедлайны источников (секунды): медленный источник отбрасывается для текущего запроса
+DEFAULT_SOURCE_DEADLINE = float(os.getenv('SOURCE_DEADLINE', 3.0))
+SOURCE_DEADLINES = {
+    "tmdb": float(os.getenv('TMDB_DEADLINE', DEFAULT_SOURCE_DEADLINE)),
+    "kinopoisk": float(os.getenv('KINOPOISK_DEADLINE', DEFAULT_SOURCE_DEADLINE)),
+    "kadikama": float(os.getenv('KADIKAMA_DEADLINE', 1.0)),
+}
+
+# Интерфейс: reply - новое сообщение с клавиатурой на каждый шаг,
+# inline - одно сообщение с inline-кнопками, которое правится на каждом шаге
+UI_MODE = os.getenv('UI_MODE', 'reply')
+INLINE_UI = UI_MODE == 'inline'
+
+# Режим работы: polling (по умолчанию) или webhook за балансировщиком
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # публичный адрес; если не задан, webhook регистрируется вручную
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', 8080))
+HEALTH_PATH = os.getenv('HEALTH_PATH', '/health')
+WEBHOOK_SHUTDOWN_TIMEOUT = float(os.getenv('WEBHOOK_SHUTDOWN_TIMEOUT', 30))  # ожидание незавершённых обновлений
+
+# Метрики Prometheus на METRICS_HOST:METRICS_PORT/metrics (0 - выключены);
+# у обработчиков при нескольких процессах порт METRICS_PORT + WORKER_ID
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9100))
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', 0.5))
 
 # Инициализация бота
-from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import InputMediaPhoto
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
 
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+storage = create_storage(FSM_STORAGE, ttl=FSM_SESSION_TTL)
 dp = Dispatcher(storage=storage)
 
 # Класс для хранения данных
-@dataclass
 class MediaItem:
-    id: int
-    title: str
-    original_title: Optional[str]
-    type: str  # movie, tv, animation
-    genres: List[str]
-    mood: List[str]
-    description: str
-    year: int
-    rating: float
-    duration: str
-    poster_url: Optional[str]
-    source: str  # tmdb, kinopoisk, kadikama
-
-# Кеш для хранения результатов
-media_cache = {}
-cache_timestamps = {}
-
-# Клавиатуры
-def get_genres_keyboard() -> ReplyKeyboardMarkup:
-    genres = ["комедия", "драма", "фантастика", "боевик", "триллер", 
-              "романтика", "ужасы", "детектив", "приключения", "аниме", 
-              "семейный", "мультфильм", "история", "биография"]
-    
-    buttons = [KeyboardButton(text=genre) for genre in genres]
-    rows = [buttons[i:i+3] for i in range(0, len(buttons), 3)]
-    rows.append([KeyboardButton(text="✅ Готово")])
-    
-    return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True)
-
-def get_mood_keyboard() -> ReplyKeyboardMarkup:
-    moods = ["весёлое", "грустное", "романтичное", "страшное", "захватывающее",
-             "расслабляющее", "вдохновляющее", "ностальгическое", "интеллектуальное"]
-    
-    buttons = [KeyboardButton(text=mood) for mood in moods]
-    rows = [buttons[i:i+3] for i in range(0, len(buttons), 3)]
-    rows.append([KeyboardButton(text="✅ Готово")])
-    
-    return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True)
-
-def get_type_keyboard() -> ReplyKeyboardMarkup:
-    types = ["фильм", "сериал", "мультфильм", "аниме", "любой"]
-    
-    buttons = [KeyboardButton(text=type_) for type_ in types]
-    rows = [buttons[i:i+3] for i in range(0, len(buttons), 3)]
-    
-    return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True)
-
-def get_reaction_keyboard() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="🎬 Буду смотреть!")],
-            [KeyboardButton(text="➡️ Следующий вариант")]
-        ],
-        resize_keyboard=True
-    )
+    """Карточка фильма/сериала.
+    
+    Жанры и настроения хранятся битовыми масками по словарям vocabulary:
+    фильтр по ним - побитовое И, а списки строк собираются только для показа
+    (в порядке словаря, а не в порядке, в котором их отдал источник).
+    """
+    __slots__ = ("id", "title", "original_title", "type", "genre_mask", "mood_mask",
+                 "description", "year", "rating", "duration", "poster_url", "source", "votes")
+    
+    def __init__(self, id: int, title: str, original_title: Optional[str], type: str,
+                 genres: List[str], mood: List[str], description: str, year: int,
+                 rating: float, duration: str, poster_url: Optional[str], source: str,
+                 votes: int = 0):
+        self.id = id
+        self.title = title
+        self.original_title = original_title
+        self.type = sys.intern(type)  # фильм, сериал, мультфильм
+        self.genre_mask = GENRE_VOCAB.mask(genres)
+        self.mood_mask = MOOD_VOCAB.mask(mood)
+        self.description = description
+        self.year = year
+        self.rating = rating
+        self.duration = duration
+        self.poster_url = poster_url
+        self.source = sys.intern(source)  # tmdb, kinopoisk, kadikama, local
+        self.votes = votes or 0  # число оценок, для ранжирования
+    
+    @property
+    def genres(self) -> List[str]:
+        return GENRE_VOCAB.names(self.genre_mask)
+    
+    @property
+    def mood(self) -> List[str]:
+        return MOOD_VOCAB.names(self.mood_mask)
+    
+    def copy(self) -> "MediaItem":
+        """Отдельная копия карточки: карточки каталога и кешей общие для всех запросов"""
+        item = MediaItem.__new__(MediaItem)
+        for name in self.__slots__:
+            setattr(item, name, getattr(self, name))
+        return item
+    
+    def to_record(self) -> list:
+        """Поля в порядке конструктора, жанры и настроения - названиями"""
+        return [self.id, self.title, self.original_title, self.type, self.genres, self.mood,
+                self.description, self.year, self.rating, self.duration, self.poster_url, self.source,
+                self.votes]
+    
+    def __repr__(self) -> str:
+        return f"MediaItem({self.source}:{self.id} {self.title!r})"
 
-def get_confirm_restart_keyboard() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Да, ищу дальше!")],
-            [KeyboardButton(text="Нет, не сегодня")]
-        ],
-        resize_keyboard=True
-    )
+def item_ref(item: MediaItem) -> str:
+    """Ссылка на карточку, уникальная между источниками"""
+    return f"{item.source}:{item.id}"
+
+def catalog_item(row: int) -> MediaItem:
+    """MediaItem строки локального каталога; часто показываемые остаются в памяти"""
+    item = catalog_item_cache.get(row)
+    if item is None:
+        item = MediaItem(**catalog.record(row))
+        catalog_item_cache.set(row, item)
+    return item
+
+def catalog_items(rows: List[int]) -> List[MediaItem]:
+    return [catalog_item(row) for row in rows]
+
+# Локальный каталог (снимок на диске, загружается через mmap)
+catalog = load_catalog(CATALOG_PATH)
+catalog_item_cache = TTLCache(maxsize=CATALOG_ITEM_CACHE_SIZE, ttl=float("inf"))
+# Признаки каталога для ранжирования читаются из столбцов снимка
+catalog_ranker = FeatureMatrix.from_catalog(catalog, catalog_item)
+ranking_weights = RankingWeights(**RANKING_WEIGHTS)
+
+def worker_limits(limits: Dict[str, float]) -> Dict[str, float]:
+    """Доля лимитов провайдера на один процесс-обработчик"""
+    if WORKER_ID is None or WORKERS <= 1:
+        return limits
+    return {
+        "rate": limits["rate"] / WORKERS,
+        "burst": max(1.0, limits["burst"] / WORKERS),
+        "daily_quota": limits["daily_quota"] // WORKERS,
+    }
+
+# Лимитеры запросов к API (счётчики квот сохраняются между перезапусками)
+quota_store = QuotaStore(QUOTA_STATE_PATH)
+rate_limiters = {
+    name: ProviderLimiter(name, max_wait=RATE_LIMIT_MAX_WAIT, store=quota_store, **worker_limits(limits))
+    for name, limits in RATE_LIMITS.items()
+}
+
+# Повторы и circuit breaker для каждого провайдера
+retry_policy = RetryPolicy(API_RETRY_ATTEMPTS, API_RETRY_BASE_DELAY, API_RETRY_MAX_DELAY)
+circuit_breakers = {
+    name: CircuitBreaker(name, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_COOLDOWN)
+    for name in RATE_LIMITS
+}
+
+# Темп отправки сообщений: на чат и на бота (доля процесса), с повтором после flood wait
+send_limiter = SendLimiter(
+    chat_rate=TELEGRAM_CHAT_RATE,
+    chat_burst=TELEGRAM_CHAT_BURST,
+    group_rate=TELEGRAM_GROUP_RATE,
+    global_rate=TELEGRAM_GLOBAL_RATE / (WORKERS if WORKER_ID is not None else 1),
+    max_retries=TELEGRAM_FLOOD_RETRIES
+)
+bot.session.middleware(send_limiter)
+
+# Общий кеш карточек: FSM хранит только ссылки на них
+item_store = ItemStore(
+    ITEM_STORE_PATH,
+    encode=lambda item: item.to_record(),
+    decode=lambda values: MediaItem(*values),
+    maxsize=ITEM_STORE_MAX_SIZE
+)
+
+# Соответствие TMDB id <-> Кинопоиск id <-> (оригинальное название, год)
+entity_index = EntityIndex(ENTITY_INDEX_PATH)
+
+# Что каждый пользователь уже видел, отклонил или выбрал
+user_history = UserHistory(HISTORY_PATH, max_users=HISTORY_MAX_USERS)
+
+def record_history(state: FSMContext, event: str, ref: str):
+    """Записывает событие по карточке вместе с её ссылками в других источниках"""
+    entity = entity_index.entity(ref)
+    refs = [ref] + (entity_index.refs(entity) if entity is not None else [])
+    user_history.record(state.key.user_id, event, refs)
+
+def take_unseen(items: List[MediaItem], seen: BloomFilter, k: int) -> Tuple[List[MediaItem], int]:
+    """Первые k карточек, которых нет в истории, и сколько карточек просмотрено"""
+    result = []
+    consumed = 0
+    for item in items:
+        if len(result) >= k:
+            break
+        consumed += 1
+        if item_ref(item) not in seen:
+            result.append(item)
+    return result, consumed
+
+# Кеш для хранения результатов (TTL + LRU)
+media_cache = TTLCache(maxsize=CACHE_MAX_SIZE, ttl=CACHE_DURATION, stale_ttl=CACHE_STALE_DURATION)
+# Второй уровень кеша ответов, общий для процессов
+shared_cache = create_shared_cache(
+    SHARED_CACHE,
+    encode=lambda items: [item.to_record() for item in items],
+    decode=lambda records: [MediaItem(*values) for values in records]
+)
+# Кеш детальной информации TMDB по (media_type, id)
+detail_cache = TTLCache(maxsize=DETAIL_CACHE_MAX_SIZE, ttl=DETAIL_CACHE_DURATION)
+# id результатов страницы discover TMDB: наши страницы - её части по SEARCH_PAGE_SIZE
+discover_cache = TTLCache(maxsize=CACHE_MAX_SIZE, ttl=CACHE_DURATION)
+# Фоновые подгрузки следующих страниц рекомендаций
+paging_tasks = set()
+
+# Метрики
+metrics_registry = Registry()
+handler_latency = metrics_registry.histogram(
+    "bot_handler_seconds", "Handler latency", ["handler"]
+)
+handler_errors = metrics_registry.counter(
+    "bot_handler_errors_total", "Handlers that raised an exception", ["handler"]
+)
+upstream_latency = metrics_registry.histogram(
+    "bot_upstream_request_seconds", "Upstream HTTP request latency, including body", ["provider"]
+)
+upstream_requests = metrics_registry.counter(
+    "bot_upstream_requests_total", "Upstream HTTP responses by status", ["provider", "status"]
+)
+upstream_errors = metrics_registry.counter(
+    "bot_upstream_errors_total", "Upstream calls that got no response", ["provider", "reason"]
+)
+cache_hit_ratio = metrics_registry.gauge("bot_cache_hit_ratio", "Cache hit ratio since start", ["cache"])
+cache_size = metrics_registry.gauge("bot_cache_entries", "Entries in cache", ["cache"])
+for cache_name, cache in (("media", media_cache), ("detail", detail_cache), ("discover", discover_cache)):
+    cache_hit_ratio.set_function(lambda cache=cache: cache.stats()["hit_ratio"], cache=cache_name)
+    cache_size.set_function(lambda cache=cache: len(cache), cache=cache_name)
+fsm_sessions = metrics_registry.gauge("bot_fsm_sessions", "Stored FSM sessions with a state")
+if hasattr(storage, "count"):
+    fsm_sessions.set_function(storage.count)
+loop_lag = metrics_registry.gauge("bot_event_loop_lag_seconds", "Latest event loop lag")
+loop_lag_histogram = metrics_registry.histogram(
+    "bot_event_loop_lag_histogram_seconds", "Event loop lag",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+metrics_runner = None
+
+@dp.message.middleware()
+async def measure_handler(handler, event, data):
+    """Длительность и ошибки каждого обработчика сообщений и нажатий кнопок"""
+    name = data["handler"].callback.__name__
+    with handler_latency.time(handler=name):
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(handler=name)
+            raise
+
+dp.callback_query.middleware(measure_handler)
+
+# Клавиатуры выбранного интерфейса
+REACTION_MARKUP = inline_ui.REACTION_KEYBOARD if INLINE_UI else REACTION_KEYBOARD
+CONFIRM_RESTART_MARKUP = inline_ui.CONFIRM_RESTART_KEYBOARD if INLINE_UI else CONFIRM_RESTART_KEYBOARD
+CLOSE_MARKUP = None if INLINE_UI else REMOVE_KEYBOARD
+# Нажатие кнопки на сообщении, которое отправил этот бот
+BOT_MESSAGE = F.message.from_user.id == bot.id
+
+def is_bot_message(message: types.Message) -> bool:
+    return message.from_user is not None and message.from_user.id == bot.id
+
+async def edit_message(edit: Awaitable) -> bool:
+    """Правка сообщения бота; False - править нельзя, нужно отправить новое"""
+    try:
+        await edit
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            return True
+        logger.warning(f"Message edit failed: {e}")
+        return False
+    return True
+
+async def reply_or_edit(message: types.Message, text: str, reply_markup=None):
+    """Ответ на шаге: в inline-режиме правит сообщение бота, иначе отправляет новое"""
+    if INLINE_UI and is_bot_message(message):
+        if message.photo:
+            edit = message.edit_caption(caption=text, parse_mode="HTML", reply_markup=reply_markup)
+        else:
+            edit = message.edit_text(text, parse_mode="HTML", reply_markup=reply_markup)
+        if await edit_message(edit):
+            return
+    await message.answer(text, parse_mode="HTML", reply_markup=reply_markup)
+
+def tmdb_media_type(media_type: str) -> str:
+    """Тип выбора пользователя -> тип TMDB"""
+    if media_type == "сериал":
+        return "tv"
+    return "movie"  # TMDB не отделяет мультфильмы
+
+# Жанры пользователя -> id жанров TMDB
+TMDB_GENRE_IDS = {
+    "комедия": 35, "драма": 18, "фантастика": 878, "боевик": 28,
+    "триллер": 53, "романтика": 10749, "ужасы": 27, "детектив": 9648,
+    "приключения": 12, "аниме": 16, "семейный": 10751, "мультфильм": 16,
+    "история": 36, "биография": 99
+}
+
+# Маппинг жанров Кинопоиска
+KINOPOISK_GENRES = {
+    "комедия": "комедия", "драма": "драма", "фантастика": "фантастика",
+    "боевик": "боевик", "триллер": "триллер", "романтика": "мелодрама",
+    "ужасы": "ужасы", "детектив": "детектив", "приключения": "приключения",
+    "аниме": "аниме", "семейный": "семейный", "мультфильм": "мультфильм",
+    "история": "история", "биография": "биография"
+}
+
+def kinopoisk_type(media_type: str) -> str:
+    """Тип выбора пользователя -> тип Кинопоиска"""
+    if media_type == "фильм":
+        return "movie"
+    if media_type == "сериал":
+        return "tv-series"
+    return "cartoon"
+
+def tmdb_search_key(genres: List[str], media_type: str, page: int = 1) -> Tuple:
+    """Ключ кеша по запросу к TMDB: первые три выбранных жанра в виде id
+    (аниме и мультфильм - один id); сортируется уже то, что уйдёт в запрос"""
+    genre_ids = list(dict.fromkeys(TMDB_GENRE_IDS[g] for g in genres if g in TMDB_GENRE_IDS))
+    return make_cache_key("tmdb", genre_ids[:3], tmdb_media_type(media_type), page)
+
+def kinopoisk_search_key(genres: List[str], media_type: str, page: int = 1) -> Tuple:
+    """Ключ кеша по запросу к Кинопоиску: фильтр по первому выбранному жанру и тип"""
+    kp_genres = [KINOPOISK_GENRES[g] for g in genres if g in KINOPOISK_GENRES]
+    return make_cache_key("kinopoisk", kp_genres[:1], kinopoisk_type(media_type), page)
 
 # Состояния FSM
 class UserState(StatesGroup):
@@ -133,237 +513,372 @@ class UserState(StatesGroup):
     confirming_restart = State()
 
 # API интеграции
+RETRY = object()  # ответ 5xx: запрос стоит повторить
+
 class MovieAPIClient:
-    def __init__(self):
-        self.session = None
+    def __init__(self, pool_config: Optional[PoolConfig] = None):
+        self.pool = SessionPool(pool_config or PoolConfig.from_env())
+        self.detail_semaphore = asyncio.Semaphore(TMDB_DETAIL_CONCURRENCY)
+        # Одинаковые одновременные запросы к API выполняются один раз
+        self.inflight = SingleFlight()
         
-    async def get_session(self):
-        if not self.session:
-            self.session = aiohttp.ClientSession()
-        return self.session
+    async def get_session(self) -> aiohttp.ClientSession:
+        return await self.pool.get()
+    
+    async def start(self):
+        """Открывает пул соединений заранее, до первого запроса"""
+        await self.pool.get()
     
     async def close(self):
-        if self.session:
-            await self.session.close()
+        await self.pool.close()
+    
+    async def get_json(self, provider: str, url: str, params: Optional[Dict] = None,
+                       headers: Optional[Dict] = None) -> Optional[Dict]:
+        """GET-запрос к API в пределах лимитов провайдера; None если ответа нет.
+        
+        Сетевые ошибки и 5xx повторяются с экспоненциальной задержкой,
+        после серии неудач провайдер отключается на время (circuit breaker).
+        """
+        breaker = circuit_breakers[provider]
+        allowed, probe = breaker.allow_request()
+        if not allowed:
+            upstream_errors.inc(provider=provider, reason="circuit_open")
+            return None
+        
+        try:
+            return await self._get_json_with_retries(provider, url, params, headers)
+        finally:
+            # Запрос, начатый до размыкания, не должен освобождать место пробного
+            if probe:
+                breaker.release()
+    
+    async def _get_json_with_retries(self, provider: str, url: str, params: Optional[Dict],
+                                     headers: Optional[Dict]) -> Optional[Dict]:
+        breaker = circuit_breakers[provider]
+        limiter = rate_limiters[provider]
+        last_error = None
+        
+        for attempt in range(retry_policy.attempts):
+            if attempt:
+                await asyncio.sleep(retry_policy.delay(attempt - 1))
+            
+            if not await limiter.acquire():
+                logger.warning(f"{provider}: request budget exhausted, using cached/local data")
+                upstream_errors.inc(provider=provider, reason="rate_limited")
+                return None
+            
+            try:
+                session = await self.get_session()
+                with upstream_latency.time(provider=provider):
+                    data = await self._get_once(provider, session, url, params, headers)
+            except asyncio.TimeoutError as e:
+                upstream_errors.inc(provider=provider, reason="timeout")
+                last_error = repr(e)
+                continue
+            except aiohttp.ClientError as e:
+                upstream_errors.inc(provider=provider, reason="connection")
+                last_error = repr(e)
+                continue
+            
+            if data is RETRY:
+                last_error = "HTTP 5xx"
+                continue
+            return data
+        
+        breaker.record_failure()
+        logger.error(f"{provider} API failed after {retry_policy.attempts} attempts: {last_error}")
+        return None
+    
+    async def _get_once(self, provider: str, session: aiohttp.ClientSession, url: str,
+                        params: Optional[Dict], headers: Optional[Dict]):
+        """Один GET-запрос: JSON ответа, None или RETRY (ошибка сервера)"""
+        breaker = circuit_breakers[provider]
+        limiter = rate_limiters[provider]
+        async with session.get(url, params=params, headers=headers) as response:
+            upstream_requests.inc(provider=provider, status=response.status)
+            if response.status == 429:
+                limiter.retry_after(response.headers.get("Retry-After"))
+                return None
+            if response.status >= 500:
+                return RETRY
+            breaker.record_success()
+            if response.status != 200:
+                logger.warning(f"{provider} API returned HTTP {response.status}")
+                return None
+            return await response.json()
+    
+    def cached_search(self, key) -> Optional[List[MediaItem]]:
+        """Ответ из кеша; устаревший ответ отдаётся сразу и обновляется в фоне"""
+        prefetcher.record_request(key)
+        cached, stale = media_cache.lookup(key)
+        if cached is None:
+            return None
+        if stale:
+            prefetcher.schedule_refresh(key)
+        return list(cached)
+    
+    async def refresh_by_key(self, key) -> List[MediaItem]:
+        """Фоновое обновление: не расходует зарезервированную часть квоты"""
+        limiter = rate_limiters.get(key[0])
+        if limiter and not limiter.has_budget(PREFETCH_QUOTA_RESERVE):
+            return []
+        # Общий кеш не читается: прогрев должен обновить его до истечения
+        return await self.fetch_by_key(key, use_shared=False)
+    
+    async def fetch_by_key(self, key, use_shared: bool = True) -> List[MediaItem]:
+        """Запрос к API по ключу кеша; одновременные запросы с одним ключом объединяются"""
+        return await self.inflight.do(key, lambda: self._fetch_by_key(key, use_shared))
     
-    async def search_tmdb(self, genre_ids: List[int], media_type: str = "movie", page: int = 1) -> List[MediaItem]:
-        """Поиск фильмов/сериалов через TMDB API"""
+    async def _fetch_by_key(self, key, use_shared: bool = True) -> List[MediaItem]:
+        if shared_cache and use_shared:
+            cached = await shared_cache.get(key)
+            if cached is not None:
+                return cached
+        
+        source, genres, media_type, page = key
+        items = []
+        if source == "tmdb":
+            items = await self._fetch_tmdb(list(genres), media_type, page, use_cache=use_shared)
+        elif source == "kinopoisk":
+            items = await self._fetch_kinopoisk(list(genres), media_type, page)
+        
+        if shared_cache and items:
+            await shared_cache.set(key, items, CACHE_DURATION)
+        return items
+    
+    async def search_tmdb(self, genres: List[str], media_type: str = "фильм", page: int = 1) -> List[MediaItem]:
+        """Поиск фильмов/сериалов через TMDB API (с кешем)"""
+        key = tmdb_search_key(genres, media_type, page)
+        cached = self.cached_search(key)
+        if cached is not None:
+            return cached
+        
+        items = await self.fetch_by_key(key)
+        if items:
+            media_cache.set(key, items)
+        return items or []
+    
+    async def _fetch_tmdb(self, genre_ids: List[int], media_type: str = "movie", page: int = 1,
+                          use_cache: bool = True) -> List[MediaItem]:
+        """Запрос к TMDB API; жанры - id TMDB, тип - тип TMDB"""
         try:
-            session = await self.get_session()
-            base_url = API_CONFIG["tmdb_base_url"]
             api_key = API_CONFIG["tmdb_api_key"]
             
             if not api_key or api_key == "ВАШ_TMDB_API_KEY":
                 return []
             
-            # Преобразуем жанры в ID TMDB
-            genre_map = {
-                "комедия": 35, "драма": 18, "фантастика": 878, "боевик": 28,
-                "триллер": 53, "романтика": 10749, "ужасы": 27, "детектив": 9648,
-                "приключения": 12, "аниме": 16, "семейный": 10751, "мультфильм": 16,
-                "история": 36, "биография": 99
-            }
-            
-            tmdb_genre_ids = [genre_map.get(g) for g in genre_ids if g in genre_map]
-            
-            url = f"{base_url}/discover/{media_type}"
-            params = {
-                "api_key": api_key,
-                "language": "ru-RU",
-                "sort_by": "popularity.desc",
-                "page": page,
-                "with_genres": "|".join(map(str, tmdb_genre_ids[:3]))
-            }
+            # Страница TMDB - 20 результатов, наша страница - SEARCH_PAGE_SIZE из них
+            offset = (page - 1) * SEARCH_PAGE_SIZE
+            item_ids = await self.tmdb_discover_ids(genre_ids, media_type, offset // TMDB_PAGE_SIZE + 1, use_cache)
+            if item_ids is None:
+                return []
+            start = offset % TMDB_PAGE_SIZE
             
-            async with session.get(url, params=params) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    results = data.get("results", [])[:5]  # Берем топ-5
-                    
-                    media_items = []
-                    for item in results:
-                        # Получаем детальную информацию
-                        detail_url = f"{base_url}/{media_type}/{item['id']}"
-                        detail_params = {"api_key": api_key, "language": "ru-RU"}
-                        
-                        async with session.get(detail_url, params=detail_params) as detail_resp:
-                            if detail_resp.status == 200:
-                                detail = await detail_resp.json()
-                                
-                                media_type_str = "фильм" if media_type == "movie" else "сериал"
-                                if "animation" in detail.get("genres", []):
-                                    media_type_str = "мультфильм"
-                                
-                                media_items.append(MediaItem(
-                                    id=item["id"],
-                                    title=detail.get("title") or detail.get("name", "Без названия"),
-                                    original_title=detail.get("original_title") or detail.get("original_name"),
-                                    type=media_type_str,
-                                    genres=[g["name"] for g in detail.get("genres", [])[:3]],
-                                    mood=[],  # TMDB не предоставляет информацию о настроении
-                                    description=detail.get("overview", "Описание отсутствует"),
-                                    year=int(detail.get("release_date", "2023")[:4]) if detail.get("release_date") else 2023,
-                                    rating=detail.get("vote_average", 0),
-                                    duration=f"{detail.get('runtime', 0)} мин" if detail.get('runtime') else "Не указано",
-                                    poster_url=f"https://image.tmdb.org/t/p/w500{detail.get('poster_path', '')}" if detail.get('poster_path') else None,
-                                    source="tmdb"
-                                ))
-                    
-                    return media_items
+            # Детальная информация запрашивается параллельно
+            details = await asyncio.gather(
+                *(self.get_tmdb_detail(item_id, media_type) for item_id in item_ids[start:start + SEARCH_PAGE_SIZE])
+            )
+            return [item for item in details if item]
                 
         except Exception as e:
             logger.error(f"TMDB API error: {e}")
             return []
     
-    async def search_kinopoisk(self, genres: List[str], media_type: str = "movie") -> List[MediaItem]:
-        """Поиск через Кинопоиск API"""
+    async def tmdb_discover_ids(self, genre_ids: List[int], media_type: str, tmdb_page: int,
+                                use_cache: bool = True) -> Optional[List[int]]:
+        """id результатов страницы discover (с кешем): несколько наших страниц -
+        один запрос к TMDB. Фоновое обновление кеш не читает, но обновляет"""
+        key = ("tmdb_discover", tuple(genre_ids), media_type, tmdb_page)
+        if use_cache:
+            cached = discover_cache.get(key)
+            if cached is not None:
+                return cached
+        return await self.inflight.do(key, lambda: self._fetch_tmdb_discover(genre_ids, media_type, tmdb_page))
+    
+    async def _fetch_tmdb_discover(self, genre_ids: List[int], media_type: str, tmdb_page: int) -> Optional[List[int]]:
+        url = f"{API_CONFIG['tmdb_base_url']}/discover/{media_type}"
+        params = {
+            "api_key": API_CONFIG["tmdb_api_key"],
+            "language": "ru-RU",
+            "sort_by": "popularity.desc",
+            "page": tmdb_page,
+            "with_genres": "|".join(map(str, genre_ids))
+        }
+        data = await self.get_json("tmdb", url, params=params)
+        if data is None:
+            return None
+        item_ids = [item["id"] for item in data.get("results", [])]
+        discover_cache.set(("tmdb_discover", tuple(genre_ids), media_type, tmdb_page), item_ids)
+        return item_ids
+    
+    async def get_tmdb_detail(self, item_id: int, media_type: str = "movie") -> Optional[MediaItem]:
+        """Детальная информация о фильме/сериале TMDB (с кешем по типу и id)"""
+        key = (media_type, item_id)
+        cached = detail_cache.get(key)
+        if cached is not None:
+            return cached
+        
+        return await self.inflight.do(
+            ("tmdb_detail", media_type, item_id),
+            lambda: self._fetch_tmdb_detail(item_id, media_type)
+        )
+    
+    async def _fetch_tmdb_detail(self, item_id: int, media_type: str = "movie") -> Optional[MediaItem]:
+        """Запрос детальной информации к TMDB API"""
+        try:
+            detail_url = f"{API_CONFIG['tmdb_base_url']}/{media_type}/{item_id}"
+            detail_params = {"api_key": API_CONFIG["tmdb_api_key"], "language": "ru-RU"}
+            
+            async with self.detail_semaphore:
+                detail = await self.get_json("tmdb", detail_url, params=detail_params)
+            if detail is None:
+                return None
+        except Exception as e:
+            logger.error(f"TMDB detail error ({media_type}/{item_id}): {e}")
+            return None
+        
+        media_type_str = "фильм" if media_type == "movie" else "сериал"
+        if "animation" in detail.get("genres", []):
+            media_type_str = "мультфильм"
+        # У сериалов TMDB вместо даты выхода - дата первого эфира
+        release_date = detail.get("first_air_date" if media_type == "tv" else "release_date")
+        
+        media_item = MediaItem(
+            id=item_id,
+            title=detail.get("title") or detail.get("name", "Без названия"),
+            original_title=detail.get("original_title") or detail.get("original_name"),
+            type=media_type_str,
+            genres=[g["name"] for g in detail.get("genres", [])[:3]],
+            mood=[],  # TMDB не предоставляет информацию о настроении
+            description=detail.get("overview", "Описание отсутствует"),
+            year=int(release_date[:4]) if release_date else 2023,
+            rating=detail.get("vote_average", 0),
+            duration=f"{detail.get('runtime', 0)} мин" if detail.get('runtime') else "Не указано",
+            poster_url=f"{API_CONFIG['tmdb_image_base_url']}{detail['poster_path']}" if detail.get('poster_path') else None,
+            source="tmdb",
+            votes=detail.get("vote_count", 0)
+        )
+        detail_cache.set((media_type, item_id), media_item)
+        return media_item
+    
+    async def search_kinopoisk(self, genres: List[str], media_type: str = "фильм", page: int = 1) -> List[MediaItem]:
+        """Поиск через Кинопоиск API (с кешем)"""
+        key = kinopoisk_search_key(genres, media_type, page)
+        cached = self.cached_search(key)
+        if cached is not None:
+            return cached
+        
+        items = await self.fetch_by_key(key)
+        if items:
+            media_cache.set(key, items)
+        return items or []
+    
+    async def _fetch_kinopoisk(self, kp_genres: List[str], kp_type: str = "movie", page: int = 1) -> List[MediaItem]:
+        """Запрос к Кинопоиск API; жанры и тип - значения Кинопоиска"""
         try:
-            session = await self.get_session()
             base_url = API_CONFIG["kinopoisk_base_url"]
             api_key = API_CONFIG["kinopoisk_api_key"]
             
             if not api_key or api_key == "ВАШ_KINOPOISK_API_KEY":
                 return []
             
-            # Маппинг жанров Кинопоиска
-            genre_map_kp = {
-                "комедия": "комедия", "драма": "драма", "фантастика": "фантастика",
-                "боевик": "боевик", "триллер": "триллер", "романтика": "мелодрама",
-                "ужасы": "ужасы", "детектив": "детектив", "приключения": "приключения",
-                "аниме": "аниме", "семейный": "семейный", "мультфильм": "мультфильм",
-                "история": "история", "биография": "биография"
-            }
-            
-            kp_genres = [genre_map_kp.get(g) for g in genres if g in genre_map_kp]
-            
             url = f"{base_url}/movie"
             params = {
                 "lists": "top250",
-                "limit": 10,
-                "selectFields": ["id", "name", "alternativeName", "year", "rating", 
+                "limit": SEARCH_PAGE_SIZE,
+                "page": page,
+                "selectFields": ["id", "name", "alternativeName", "year", "rating", "votes",
                                 "genres", "description", "movieLength", "poster", "type"],
-                "type": "movie" if media_type == "фильм" else "tv-series" if media_type == "сериал" else "cartoon"
+                "type": kp_type
             }
             
             if kp_genres:
-                params["genres.name"] = kp_genres[0]  # Берем первый жанр для фильтрации
+                params["genres.name"] = kp_genres[0]  # Фильтр по одному жанру
             
             headers = {"X-API-KEY": api_key}
             
-            async with session.get(url, params=params, headers=headers) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    docs = data.get("docs", [])[:5]
-                    
-                    media_items = []
-                    for doc in docs:
-                        media_type_str = "фильм"
-                        if doc.get("type") == "tv-series":
-                            media_type_str = "сериал"
-                        elif doc.get("type") == "cartoon":
-                            media_type_str = "мультфильм"
-                        
-                        # Определяем настроение по жанрам
-                        mood_map = {
-                            "комедия": ["весёлое"],
-                            "драма": ["грустное", "вдохновляющее"],
-                            "фантастика": ["захватывающее"],
-                            "боевик": ["захватывающее"],
-                            "триллер": ["страшное", "захватывающее"],
-                            "мелодрама": ["романтичное"],
-                            "ужасы": ["страшное"],
-                            "детектив": ["интеллектуальное"],
-                            "приключения": ["захватывающее"],
-                            "аниме": ["вдохновляющее"],
-                            "семейный": ["расслабляющее"],
-                            "мультфильм": ["весёлое"],
-                            "биография": ["вдохновляющее"]
-                        }
-                        
-                        moods = []
-                        for genre in doc.get("genres", []):
-                            if genre.get("name") in mood_map:
-                                moods.extend(mood_map[genre["name"]])
-                        
-                        media_items.append(MediaItem(
-                            id=doc["id"],
-                            title=doc.get("name", "Без названия"),
-                            original_title=doc.get("alternativeName"),
-                            type=media_type_str,
-                            genres=[g["name"] for g in doc.get("genres", [])[:3]],
-                            mood=list(set(moods))[:3],
-                            description=doc.get("description", "Описание отсутствует")[:300] + "...",
-                            year=doc.get("year", 2023),
-                            rating=doc.get("rating", {}).get("kp", 0),
-                            duration=f"{doc.get('movieLength', 0)} мин",
-                            poster_url=doc.get("poster", {}).get("url") if doc.get("poster") else None,
-                            source="kinopoisk"
-                        ))
-                    
-                    return media_items
+            data = await self.get_json("kinopoisk", url, params=params, headers=headers)
+            if data is None:
+                return []
+            docs = data.get("docs", [])
+            
+            media_items = []
+            for doc in docs:
+                media_type_str = "фильм"
+                if doc.get("type") == "tv-series":
+                    media_type_str = "сериал"
+                elif doc.get("type") == "cartoon":
+                    media_type_str = "мультфильм"
+                
+                # Определяем настроение по жанрам
+                mood_map = {
+                    "комедия": ["весёлое"],
+                    "драма": ["грустное", "вдохновляющее"],
+                    "фантастика": ["захватывающее"],
+                    "боевик": ["захватывающее"],
+                    "триллер": ["страшное", "захватывающее"],
+                    "мелодрама": ["романтичное"],
+                    "ужасы": ["страшное"],
+                    "детектив": ["интеллектуальное"],
+                    "приключения": ["захватывающее"],
+                    "аниме": ["вдохновляющее"],
+                    "семейный": ["расслабляющее"],
+                    "мультфильм": ["весёлое"],
+                    "биография": ["вдохновляющее"]
+                }
                 
+                moods = []
+                for genre in doc.get("genres", []):
+                    if genre.get("name") in mood_map:
+                        moods.extend(mood_map[genre["name"]])
+                
+                media_items.append(MediaItem(
+                    id=doc["id"],
+                    title=doc.get("name", "Без названия"),
+                    original_title=doc.get("alternativeName"),
+                    type=media_type_str,
+                    genres=[g["name"] for g in doc.get("genres", [])[:3]],
+                    mood=list(set(moods))[:3],
+                    description=doc.get("description", "Описание отсутствует")[:300] + "...",
+                    year=doc.get("year", 2023),
+                    rating=doc.get("rating", {}).get("kp", 0),
+                    duration=f"{doc.get('movieLength', 0)} мин",
+                    poster_url=doc.get("poster", {}).get("url") if doc.get("poster") else None,
+                    source="kinopoisk",
+                    votes=(doc.get("votes") or {}).get("kp", 0)
+                ))
+            
+            return media_items
+        
         except Exception as e:
             logger.error(f"Kinopoisk API error: {e}")
             return []
     
+    async def fetch_trending(self, media_type: str = "movie", window: str = "week") -> Optional[List[Dict]]:
+        """Популярное на TMDB за день или неделю; None если API недоступно"""
+        api_key = API_CONFIG["tmdb_api_key"]
+        if not api_key or api_key == "ВАШ_TMDB_API_KEY":
+            return None
+        
+        url = f"{API_CONFIG['tmdb_base_url']}/trending/{media_type}/{window}"
+        data = await self.get_json("tmdb", url, params={"api_key": api_key, "language": "ru-RU"})
+        return data.get("results") if data else None
+    
     async def search_kadikama(self, mood: str = None) -> List[MediaItem]:
         """Получение случайных рекомендаций с Kadikama"""
         try:
             # Kadikama.info - парсинг сайта (упрощенная версия)
             # В реальном проекте нужен парсинг с BeautifulSoup
             
-            # Заглушка с локальной базой на случай недоступности API
-            fallback_items = [
-                MediaItem(
-                    id=1001,
-                    title="Ведьмак",
-                    original_title="The Witcher",
-                    type="сериал",
-                    genres=["фантастика", "приключения", "драма"],
-                    mood=["захватывающее", "мрачное"],
-                    description="Геральт из Ривии, мутировавший охотник на чудовищ, путешествует по Континенту.",
-                    year=2019,
-                    rating=8.2,
-                    duration="1 сезон",
-                    poster_url=None,
-                    source="kadikama"
-                ),
-                MediaItem(
-                    id=1002,
-                    title="Игра в кальмара",
-                    original_title="Squid Game",
-                    type="сериал",
-                    genres=["триллер", "драма", "выживание"],
-                    mood=["страшное", "захватывающее"],
-                    description="Участники играют в детские игры на выживание ради большого денежного приза.",
-                    year=2021,
-                    rating=8.0,
-                    duration="1 сезон",
-                    poster_url=None,
-                    source="kadikama"
-                ),
-                MediaItem(
-                    id=1003,
-                    title="Энканто",
-                    original_title="Encanto",
-                    type="мультфильм",
-                    genres=["мультфильм", "фэнтези", "мюзикл"],
-                    mood=["весёлое", "вдохновляющее"],
-                    description="Магическая история о семье Мадригаль, живущей в волшебном доме в Колумбии.",
-                    year=2021,
-                    rating=7.2,
-                    duration="1ч 42м",
-                    poster_url=None,
-                    source="kadikama"
-                ),
-            ]
+            # Заглушка: записи Kadikama из локального каталога
+            fallback_rows = catalog.query(source="kadikama")
             
             # Фильтрация по настроению если указано
             if mood:
-                filtered = [item for item in fallback_items if mood in item.mood]
-                return filtered if filtered else fallback_items
+                filtered = catalog.query(moods=[mood], source="kadikama")
+                return catalog_items(filtered if filtered else fallback_rows)
             
-            return fallback_items
+            return catalog_items(fallback_rows)
             
         except Exception as e:
             logger.error(f"Kadikama error: {e}")
@@ -371,6 +886,58 @@ class MovieAPIClient:
 
 # Инициализация API клиента
 api_client = MovieAPIClient()
+# file_id загруженных в Telegram постеров по ссылке на карточку
+poster_store = ItemStore(POSTER_STORE_PATH, table="poster_file_ids")
+poster_pipeline = PosterPipeline(poster_store, api_client.get_session, max_side=POSTER_MAX_SIDE)
+
+def prefetch_keys() -> List:
+    """Сетка жанр x тип для источников, у которых есть ключ API и нет дневной квоты.
+    Источники с квотой прогреваются только популярными ключами: полная сетка
+    съела бы резерв прогрева за первые проходы после сброса квоты"""
+    use_tmdb = (API_CONFIG["tmdb_api_key"] and API_CONFIG["tmdb_api_key"] != "ВАШ_TMDB_API_KEY"
+                and not RATE_LIMITS["tmdb"]["daily_quota"])
+    use_kinopoisk = (API_CONFIG["kinopoisk_api_key"] and API_CONFIG["kinopoisk_api_key"] != "ВАШ_KINOPOISK_API_KEY"
+                     and not RATE_LIMITS["kinopoisk"]["daily_quota"])
+    keys = []
+    for genre in GENRES:
+        for media_type in MEDIA_TYPES:
+            if use_tmdb:
+                keys.append(tmdb_search_key([genre], media_type))
+            if use_kinopoisk:
+                keys.append(kinopoisk_search_key([genre], media_type))
+    # Разные выборы, которые дают один запрос к API, прогреваются один раз
+    return list(dict.fromkeys(keys))
+
+prefetcher = CachePrefetcher(
+    media_cache,
+    api_client.refresh_by_key,
+    base_keys=prefetch_keys(),
+    interval=PREFETCH_INTERVAL,
+    rate=PREFETCH_RATE,
+    jitter=PREFETCH_JITTER,
+    popular_limit=PREFETCH_POPULAR_KEYS
+)
+
+def local_trending_text(media_type: str) -> Optional[str]:
+    """Лучшее из локального каталога - пока не было ни одного ответа TMDB"""
+    items = catalog_items(catalog.query(media_type="сериал" if media_type == TV else "фильм")[:TRENDING_LIMIT])
+    if not items:
+        return None
+    lines = ["📈 <b>Популярное в нашей подборке:</b>", ""]
+    lines += [f"{i}. <b>{item.title}</b> ({item.year}) ⭐ {item.rating}/10" for i, item in enumerate(items, 1)]
+    return "\n".join(lines)
+
+trending_board = TrendingBoard(
+    api_client.fetch_trending,
+    path=TRENDING_PATH,
+    limit=TRENDING_LIMIT,
+    interval=TRENDING_INTERVAL,
+    retry_interval=TRENDING_RETRY_INTERVAL
+)
+for media_type in (MOVIE, TV):
+    fallback_text = local_trending_text(media_type)
+    if fallback_text:
+        trending_board.set_fallback(media_type, fallback_text)
 
 # Обработчики команд
 @dp.message(Command("start"))
@@ -384,8 +951,11 @@ async def cmd_start(message: types.Message, state: FSMContext):
         "Использую данные из <b>TMDB, Кинопоиска и Kadikama</b>.\n\n"
         "Давайте начнем! Выберите один или несколько жанров:",
         parse_mode="HTML",
-        reply_markup=get_genres_keyboard()
+        reply_markup=inline_ui.genres_keyboard(0) if INLINE_UI else GENRES_KEYBOARD
     )
+    if INLINE_UI:
+        # Выбор до типа хранится в кнопках, FSM не нужен
+        return
     await state.set_state(UserState.choosing_genres)
     await state.update_data(genres=[], mood=[], media_type=None)
 
@@ -397,7 +967,8 @@ async def cmd_help(message: types.Message):
         "<b>Команды:</b>\n"
         "/start - начать подбор\n"
         "/help - эта справка\n"
-        "/trending - популярное сейчас\n\n"
+        "/trending - популярное сейчас\n"
+        "/trending tv day - сериалы за сегодня\n\n"
         "<b>Источники данных:</b>\n"
         "• The Movie Database (TMDB)\n"
         "• Кинопоиск\n"
@@ -411,47 +982,12 @@ async def cmd_help(message: types.Message):
     )
 
 @dp.message(Command("trending"))
-async def cmd_trending(message: types.Message):
-    """Популярные фильмы прямо сейчас"""
-    try:
-        # Получаем тренды с TMDB
-        session = await api_client.get_session()
-        api_key = API_CONFIG["tmdb_api_key"]
-        
-        if api_key and api_key != "ВАШ_TMDB_API_KEY":
-            url = f"{API_CONFIG['tmdb_base_url']}/trending/movie/week"
-            params = {"api_key": api_key, "language": "ru-RU"}
-            
-            async with session.get(url, params=params) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    trending = data.get("results", [])[:5]
-                    
-                    response_text = "📈 <b>Популярное на этой неделе:</b>\n\n"
-                    
-                    for i, movie in enumerate(trending, 1):
-                        title = movie.get("title", "Без названия")
-                        rating = movie.get("vote_average", 0)
-                        year = movie.get("release_date", "2023")[:4] if movie.get("release_date") else "2023"
-                        
-                        response_text += f"{i}. <b>{title}</b> ({year}) ⭐ {rating}/10\n"
-                    
-                    await message.answer(response_text, parse_mode="HTML")
-                    return
-        
-        # Если API недоступно, показываем локальные данные
-        await message.answer(
-            "📈 <b>Сейчас в тренде:</b>\n\n"
-            "1. <b>Дюна: Часть вторая</b> (2024) ⭐ 8.5/10\n"
-            "2. <b>Оппенгеймер</b> (2023) ⭐ 8.3/10\n"
-            "3. <b>Барби</b> (2023) ⭐ 7.5/10\n"
-            "4. <b>Миссия невыполнима 7</b> (2023) ⭐ 7.0/10\n"
-            "5. <b>Человек-паук: Паутина вселенных</b> (2023) ⭐ 8.7/10",
-            parse_mode="HTML"
-        )
-        
-    except Exception as e:
-        logger.error(f"Trending error: {e}")
+async def cmd_trending(message: types.Message, command: CommandObject):
+    """Популярное сейчас: /trending [tv] [day] - готовый текст из фонового снимка"""
+    text = trending_board.text(*parse_trending_args(command.args))
+    if text:
+        await message.answer(text, parse_mode="HTML")
+    else:
         await message.answer("😕 Не могу получить популярные фильмы. Попробуйте позже.")
 
 # Обработка выбора жанров
@@ -460,40 +996,36 @@ async def process_genres(message: types.Message, state: FSMContext):
     user_data = await state.get_data()
     selected_genres = user_data.get("genres", [])
     
-    if message.text == "✅ Готово":
+    if message.text == DONE_BUTTON:
         if not selected_genres:
             await message.answer("Пожалуйста, выберите хотя бы один жанр!")
             return
         
         await message.answer(
-            f"✅ Выбраны жанры: <b>{', '.join(selected_genres)}</b>\n\n"
-            "Теперь выберите настроение для просмотра:",
+            GENRES_DONE_TEMPLATE(', '.join(selected_genres)),
             parse_mode="HTML",
-            reply_markup=get_mood_keyboard()
+            reply_markup=MOOD_KEYBOARD
         )
         await state.set_state(UserState.choosing_mood)
         return
     
-    valid_genres = ["комедия", "драма", "фантастика", "боевик", "триллер", 
-                    "романтика", "ужасы", "детектив", "приключения", "аниме", 
-                    "семейный", "мультфильм", "история", "биография"]
-    
-    if message.text not in valid_genres:
+    if message.text not in GENRE_SET:
         await message.answer("Пожалуйста, выберите жанр из предложенных!")
         return
     
     if message.text in selected_genres:
         selected_genres.remove(message.text)
-        await message.answer(f"❌ Жанр <b>'{message.text}'</b> удалён", parse_mode="HTML")
+        reply = GENRE_REMOVED[message.text]
     else:
         selected_genres.append(message.text)
-        await message.answer(f"✅ Жанр <b>'{message.text}'</b> добавлен!", parse_mode="HTML")
+        reply = GENRE_ADDED[message.text]
     
     await state.update_data(genres=selected_genres)
     
+    # Подтверждение и текущий выбор - одним сообщением
     if selected_genres:
-        await message.answer(f"📋 Выбрано: <b>{', '.join(selected_genres)}</b>\nНажмите '✅ Готово' когда закончите", 
-                           parse_mode="HTML")
+        reply += "\n\n" + SELECTED_TEMPLATE(', '.join(selected_genres))
+    await message.answer(reply, parse_mode="HTML")
 
 # Обработка выбора настроения
 @dp.message(UserState.choosing_mood)
@@ -501,46 +1033,40 @@ async def process_mood(message: types.Message, state: FSMContext):
     user_data = await state.get_data()
     selected_mood = user_data.get("mood", [])
     
-    if message.text == "✅ Готово":
+    if message.text == DONE_BUTTON:
         if not selected_mood:
             await message.answer("Пожалуйста, выберите хотя бы одно настроение!")
             return
         
         await message.answer(
-            f"✅ Настроение: <b>{', '.join(selected_mood)}</b>\n\n"
-            "Теперь выберите тип:",
+            MOOD_DONE_TEMPLATE(', '.join(selected_mood)),
             parse_mode="HTML",
-            reply_markup=get_type_keyboard()
+            reply_markup=TYPE_KEYBOARD
         )
         await state.set_state(UserState.choosing_type)
         return
     
-    valid_moods = ["весёлое", "грустное", "романтичное", "страшное", "захватывающее",
-                   "расслабляющее", "вдохновляющее", "ностальгическое", "интеллектуальное"]
-    
-    if message.text not in valid_moods:
+    if message.text not in MOOD_SET:
         await message.answer("Пожалуйста, выберите настроение из предложенных!")
         return
     
     if message.text in selected_mood:
         selected_mood.remove(message.text)
-        await message.answer(f"❌ Настроение <b>'{message.text}'</b> удалено", parse_mode="HTML")
+        reply = MOOD_REMOVED[message.text]
     else:
         selected_mood.append(message.text)
-        await message.answer(f"✅ Настроение <b>'{message.text}'</b> добавлено!", parse_mode="HTML")
+        reply = MOOD_ADDED[message.text]
     
     await state.update_data(mood=selected_mood)
     
     if selected_mood:
-        await message.answer(f"📋 Выбрано: <b>{', '.join(selected_mood)}</b>\nНажмите '✅ Готово' когда закончите",
-                           parse_mode="HTML")
+        reply += "\n\n" + SELECTED_TEMPLATE(', '.join(selected_mood))
+    await message.answer(reply, parse_mode="HTML")
 
 # Обработка выбора типа
 @dp.message(UserState.choosing_type)
 async def process_type(message: types.Message, state: FSMContext):
-    valid_types = ["фильм", "сериал", "мультфильм", "аниме", "любой"]
-    
-    if message.text not in valid_types:
+    if message.text not in MEDIA_TYPE_SET:
         await message.answer("Пожалуйста, выберите тип из предложенных!")
         return
     
@@ -548,99 +1074,218 @@ async def process_type(message: types.Message, state: FSMContext):
     user_data = await state.get_data()
     
     # Показываем итоги
-    summary = (
-        f"🎯 <b>Ваши предпочтения:</b>\n\n"
-        f"<b>Жанры:</b> {', '.join(user_data['genres'])}\n"
-        f"<b>Настроение:</b> {', '.join(user_data['mood'])}\n"
-        f"<b>Тип:</b> {user_data['media_type']}\n\n"
-        f"🔍 Ищу рекомендации по вашим критериям..."
+    summary = SUMMARY_TEMPLATE(
+        genres=', '.join(user_data['genres']),
+        moods=', '.join(user_data['mood']),
+        media_type=user_data['media_type']
     )
     
-    await message.answer(summary, parse_mode="HTML", reply_markup=ReplyKeyboardRemove())
+    await message.answer(summary, parse_mode="HTML", reply_markup=REMOVE_KEYBOARD)
     
     # Ищем рекомендации из всех источников
     await search_recommendations(message, state)
 
+# Выбор жанров, настроения и типа inline-кнопками: выбор хранится в callback_data
+@dp.callback_query(BOT_MESSAGE, F.data.func(inline_ui.decode).as_("step"))
+async def process_selection_callback(callback: types.CallbackQuery, state: FSMContext, step):
+    prefix, values = step
+    message = callback.message
+    
+    if prefix == inline_ui.GENRE:
+        await callback.answer()
+        await edit_message(message.edit_reply_markup(reply_markup=inline_ui.genres_keyboard(*values)))
+    
+    elif prefix == inline_ui.GENRES_DONE:
+        genres = inline_ui.selected(values[0], GENRES)
+        if not genres:
+            await callback.answer("Пожалуйста, выберите хотя бы один жанр!")
+            return
+        await callback.answer()
+        await edit_message(message.edit_text(
+            GENRES_DONE_TEMPLATE(', '.join(genres)),
+            parse_mode="HTML",
+            reply_markup=inline_ui.mood_keyboard(values[0], 0)
+        ))
+    
+    elif prefix == inline_ui.MOOD:
+        await callback.answer()
+        await edit_message(message.edit_reply_markup(reply_markup=inline_ui.mood_keyboard(*values)))
+    
+    elif prefix == inline_ui.MOOD_DONE:
+        moods = inline_ui.selected(values[1], MOODS)
+        if not moods:
+            await callback.answer("Пожалуйста, выберите хотя бы одно настроение!")
+            return
+        await callback.answer()
+        await edit_message(message.edit_text(
+            MOOD_DONE_TEMPLATE(', '.join(moods)),
+            parse_mode="HTML",
+            reply_markup=inline_ui.type_keyboard(*values)
+        ))
+    
+    else:
+        genre_mask, mood_mask, type_index = values
+        await callback.answer()
+        user_data = {
+            "genres": inline_ui.selected(genre_mask, GENRES),
+            "mood": inline_ui.selected(mood_mask, MOODS),
+            "media_type": MEDIA_TYPES[type_index],
+        }
+        await state.set_data(user_data)
+        summary = SUMMARY_TEMPLATE(
+            genres=', '.join(user_data['genres']),
+            moods=', '.join(user_data['mood']),
+            media_type=user_data['media_type']
+        )
+        await edit_message(message.edit_text(summary, parse_mode="HTML"))
+        await search_recommendations(message, state)
+
+async def query_source(name: str, coro) -> List[MediaItem]:
+    """Запрос к одному источнику с дедлайном и замером времени"""
+    deadline = SOURCE_DEADLINES.get(name, DEFAULT_SOURCE_DEADLINE)
+    # Задача защищена от отмены: опоздавший ответ всё равно попадёт в кеш
+    task = asyncio.ensure_future(coro)
+    started = time.perf_counter()
+    
+    try:
+        items = await asyncio.wait_for(asyncio.shield(task), timeout=deadline)
+    except asyncio.TimeoutError:
+        logger.warning(f"Source {name} dropped: no response within {deadline:.1f}s")
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return []
+    except Exception as e:
+        logger.error(f"Source {name} error: {e}")
+        return []
+    
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    logger.info(f"Source {name}: {len(items or [])} items in {elapsed_ms:.0f} ms")
+    return items or []
+
+def merge_duplicates(items: List[MediaItem]) -> List[MediaItem]:
+    """Одна карточка на фильм: дубликаты находятся по индексу сущностей,
+    недостающие поля первой карточки дополняются из остальных.
+    Дополняется копия: исходные карточки лежат в каталоге и кешах"""
+    merged: Dict[int, MediaItem] = {}
+    copied = set()
+    for item, entity in zip(items, entity_index.resolve_many(items, ref=item_ref)):
+        primary = merged.get(entity)
+        if primary is None:
+            merged[entity] = item
+            continue
+        if entity not in copied:
+            primary = merged[entity] = primary.copy()
+            copied.add(entity)
+        enrich_item(primary, item)
+    return list(merged.values())
+
+def enrich_item(target: MediaItem, other: MediaItem):
+    """Дополняет карточку данными того же фильма из другого источника"""
+    if not target.poster_url:
+        target.poster_url = other.poster_url
+    if not target.original_title:
+        target.original_title = other.original_title
+    if target.duration in (None, "", "Не указано", "0 мин"):
+        target.duration = other.duration
+    if target.description in (None, "", "Описание отсутствует"):
+        target.description = other.description
+    target.genre_mask |= other.genre_mask
+    target.mood_mask |= other.mood_mask
+    target.votes = max(target.votes, other.votes)
+
+async def stream_sources(sources: Dict[str, Any]) -> AsyncIterator[List[MediaItem]]:
+    """Результаты источников по мере готовности, самый быстрый - первым"""
+    tasks = [asyncio.ensure_future(query_source(name, coro)) for name, coro in sources.items()]
+    for next_done in asyncio.as_completed(tasks):
+        yield await next_done
+
+@timed(handler_latency, handler="search_recommendations")
 async def search_recommendations(message: types.Message, state: FSMContext):
     """Поиск рекомендаций из всех источников"""
     user_data = await state.get_data()
+    query = RankQuery.from_selection(user_data["genres"], user_data["mood"], user_data["media_type"])
+    seen = user_history.filter(state.key.user_id)
     
-    all_recommendations = []
+    # Сначала локальный каталог: пересечение индексов без обращения к API
+    local_rows = catalog.query(
+        genres=user_data["genres"],
+        moods=user_data["mood"],
+        media_type=user_data["media_type"]
+    )
+    
+    if len(local_rows) >= LOCAL_CATALOG_MIN_RESULTS:
+        # Каталог покрывает запрос целиком - внешние источники не нужны
+        # Берём с запасом на размер истории: после фильтрации останется не меньше лимита
+        ranked = catalog_ranker.top_k(query, RECOMMENDATIONS_LIMIT + seen.count, ranking_weights, rows=local_rows)
+        recommendations, consumed = take_unseen(ranked, seen, RECOMMENDATIONS_LIMIT)
+        if not recommendations:
+            recommendations, consumed = ranked[:RECOMMENDATIONS_LIMIT], RECOMMENDATIONS_LIMIT
+        await start_recommendations(message, state, recommendations, cursor={"catalog": consumed})
+        return
+    
+    sources = {}
     
     # Поиск из TMDB
     if API_CONFIG["tmdb_api_key"] and API_CONFIG["tmdb_api_key"] != "ВАШ_TMDB_API_KEY":
-        tmdb_type = "movie"
-        if user_data["media_type"] == "сериал":
-            tmdb_type = "tv"
-        elif user_data["media_type"] == "мультфильм":
-            tmdb_type = "movie"  # TMDB не отделяет мультфильмы
-        
-        tmdb_results = await api_client.search_tmdb(
-            genre_ids=user_data["genres"],
-            media_type=tmdb_type
+        sources["tmdb"] = api_client.search_tmdb(
+            genres=user_data["genres"],
+            media_type=user_data["media_type"]
         )
-        all_recommendations.extend(tmdb_results)
     
     # Поиск из Кинопоиска
     if API_CONFIG["kinopoisk_api_key"] and API_CONFIG["kinopoisk_api_key"] != "ВАШ_KINOPOISK_API_KEY":
-        kp_results = await api_client.search_kinopoisk(
+        sources["kinopoisk"] = api_client.search_kinopoisk(
             genres=user_data["genres"],
             media_type=user_data["media_type"]
         )
-        all_recommendations.extend(kp_results)
     
     # Поиск из Kadikama (основываясь на настроении)
     if user_data["mood"]:
-        kadikama_results = await api_client.search_kadikama(mood=user_data["mood"][0])
-        all_recommendations.extend(kadikama_results)
+        sources["kadikama"] = api_client.search_kadikama(mood=user_data["mood"][0])
+    
+    # Следующие страницы запрашиваются лениво, когда очередь подходит к концу
+    cursor = {name: 2 for name in sources if name in PAGED_SOURCES}
+    
+    # Источники опрашиваются параллельно; первая достаточно хорошая
+    # рекомендация показывается, не дожидаясь самого медленного из них
+    all_recommendations = []
+    first_item = None
+    async for source_items in stream_sources(sources):
+        all_recommendations.extend(source_items)
+        if first_item is None and source_items:
+            candidates = [item for item in merge_duplicates(all_recommendations) if item_ref(item) not in seen]
+            candidate, score = best_candidate(candidates, query, ranking_weights)
+            if candidate is not None and score >= FIRST_RESULT_MIN_SCORE:
+                first_item = candidate
+                await start_recommendations(message, state, [first_item], cursor=cursor)
     
     # Если нет результатов из API, используем локальные данные
     if not all_recommendations:
-        # Локальная база на случай если API недоступны
-        local_db = [
-            MediaItem(1, "Начало", "Inception", "фильм", ["фантастика", "триллер"], 
-                     ["интеллектуальное", "захватывающее"], "Сны внутри снов...", 2010, 8.8, "2ч 28м", None, "local"),
-            MediaItem(2, "Побег из Шоушенка", "The Shawshank Redemption", "фильм", ["драма"], 
-                     ["вдохновляющее", "грустное"], "История надежды в тюрьме...", 1994, 9.3, "2ч 22м", None, "local"),
-            MediaItem(3, "Король Лев", "The Lion King", "мультфильм", ["мультфильм", "драма"], 
-                     ["трогательное", "вдохновляющее"], "История львёнка Симбы...", 1994, 8.5, "1ч 28м", None, "local"),
-            MediaItem(4, "Острые козырьки", "Peaky Blinders", "сериал", ["криминал", "драма"], 
-                     ["стильное", "захватывающее"], "Британская криминальная сага...", 2013, 8.8, "6 сезонов", None, "local"),
-            MediaItem(5, "Друзья", "Friends", "сериал", ["комедия"], 
-                     ["весёлое", "расслабляющее"], "Жизнь шести друзей в Нью-Йорке...", 1994, 8.9, "10 сезонов", None, "local"),
-        ]
-        
-        # Фильтрация локальных данных
-        filtered_local = []
-        for item in local_db:
-            # Фильтр по типу
-            if user_data["media_type"] != "любой" and item.type != user_data["media_type"]:
-                continue
-            
-            # Фильтр по жанрам
-            if user_data["genres"] and not any(genre in item.genres for genre in user_data["genres"]):
-                continue
-            
-            # Фильтр по настроению
-            if user_data["mood"] and not any(mood in item.mood for mood in user_data["mood"]):
-                continue
-            
-            filtered_local.append(item)
-        
-        all_recommendations = filtered_local if filtered_local else local_db[:3]
+        all_recommendations = catalog_items(local_rows) if local_rows else catalog_items(
+            catalog.query(source="local")[:3]
+        )
+    
+    # Объединяем один и тот же фильм из разных источников
+    unique_recommendations = merge_duplicates(all_recommendations)
     
-    # Убираем дубликаты по названию
-    unique_recommendations = []
-    seen_titles = set()
-    for item in all_recommendations:
-        if item.title not in seen_titles:
-            seen_titles.add(item.title)
-            unique_recommendations.append(item)
+    # Уже виденное не предлагаем, если есть из чего выбрать
+    unique_recommendations = [
+        item for item in unique_recommendations if item_ref(item) not in seen
+    ] or unique_recommendations
     
-    # Сортируем по рейтингу и берем первые 10
-    unique_recommendations.sort(key=lambda x: x.rating, reverse=True)
-    recommendations = unique_recommendations[:10]
+    # Оцениваем совпадение с запросом и берём лучшие
+    recommendations = rank_items(unique_recommendations, query, RECOMMENDATIONS_LIMIT, ranking_weights)
     
+    if first_item is None:
+        await start_recommendations(message, state, recommendations, cursor=cursor)
+    else:
+        # Первая рекомендация уже показана: остальные встают в очередь после неё
+        await extend_recommendations(state, recommendations)
+    schedule_next_page(state, await state.get_data())
+
+async def start_recommendations(message: types.Message, state: FSMContext, recommendations: List[MediaItem],
+                                cursor: Optional[Dict[str, int]] = None):
+    """Сохраняет очередь рекомендаций и показывает первую.
+    cursor - следующая страница каждого источника (для каталога - смещение)"""
     if not recommendations:
         await message.answer(
             "😕 К сожалению, по вашим критериям ничего не найдено.\n"
@@ -649,31 +1294,164 @@ async def search_recommendations(message: types.Message, state: FSMContext):
         await state.clear()
         return
     
-    # Сохраняем рекомендации в состоянии
+    # Карточки - в общий кеш, в состоянии только ссылки на них
+    item_store.put_many({item_ref(item): item for item in recommendations})
     await state.update_data(
-        recommendations=[item.id for item in recommendations],
-        recommendations_data={item.id: item for item in recommendations},
+        recommendations=[item_ref(item) for item in recommendations],
         current_index=0,
-        recommendations_shown=0
+        recommendations_shown=0,
+        cursor=cursor or {}
     )
     
     # Показываем первую рекомендацию
     await show_recommendation(message, state, recommendations[0])
 
-async def show_recommendation(message: types.Message, state: FSMContext, media_item: MediaItem):
-    """Показ рекомендации"""
-    # Эмодзи для типа
-    type_emoji = {
-        "фильм": "🎥", "сериал": "📺", "мультфильм": "🐭", "аниме": "🌸"
-    }.get(media_item.type, "🎬")
+async def extend_recommendations(state: FSMContext, recommendations: List[MediaItem]):
+    """Добавляет полный результат поиска в очередь, если пользователь ещё листает.
+    Очередь до текущей карточки не меняется, новые карточки встают сразу после
+    неё, а уже подгруженные следующие страницы - за ними"""
+    current_state = await state.get_state()
+    if current_state not in (UserState.viewing_recommendations.state, UserState.confirming_restart.state):
+        return
+    
+    user_data = await state.get_data()
+    queued = user_data.get("recommendations", [])
+    # Тот же фильм мог прийти под другой ссылкой или копией после объединения
+    queued_entities = {entity_index.entity(ref) for ref in queued} - {None}
+    fresh = [
+        item for item in recommendations
+        if item_ref(item) not in queued and entity_index.entity(item_ref(item)) not in queued_entities
+    ]
+    head = user_data.get("current_index", 0) + 1
+    
+    item_store.put_many({item_ref(item): item for item in fresh})
+    await state.update_data(
+        recommendations=queued[:head] + [item_ref(item) for item in fresh] + queued[head:]
+    )
+
+async def fetch_next_page(user_data: Dict[str, Any], seen: BloomFilter) -> Tuple[List[MediaItem], Dict[str, int]]:
+    """Следующая страница кандидатов по курсору сессии и обновлённый курсор.
+    Источник, вернувший пустую страницу, из курсора убирается"""
+    cursor = dict(user_data.get("cursor") or {})
+    sources = {}
+    for name, page in cursor.items():
+        if name == "tmdb":
+            sources[name] = api_client.search_tmdb(
+                genres=user_data["genres"],
+                media_type=user_data["media_type"],
+                page=page
+            )
+        elif name == "kinopoisk":
+            sources[name] = api_client.search_kinopoisk(
+                genres=user_data["genres"],
+                media_type=user_data["media_type"],
+                page=page
+            )
+    
+    items = []
+    results = await asyncio.gather(*(query_source(name, coro) for name, coro in sources.items()))
+    for name, source_items in zip(sources, results):
+        items.extend(source_items)
+        if source_items and cursor[name] < PAGING_MAX_PAGE:
+            cursor[name] += 1
+        else:
+            del cursor[name]
+    
+    if "catalog" in cursor:
+        offset = cursor.pop("catalog")
+        rows = catalog.query(
+            genres=user_data["genres"],
+            moods=user_data["mood"],
+            media_type=user_data["media_type"]
+        )
+        ranked = catalog_ranker.top_k(
+            RankQuery.from_selection(user_data["genres"], user_data["mood"], user_data["media_type"]),
+            offset + RECOMMENDATIONS_LIMIT + seen.count, ranking_weights, rows=rows
+        )[offset:]
+        page_items, consumed = take_unseen(ranked, seen, RECOMMENDATIONS_LIMIT)
+        if page_items:
+            items.extend(page_items)
+            cursor["catalog"] = offset + consumed
+    
+    return items, cursor
+
+async def load_next_page(state: FSMContext) -> int:
+    """Дописывает в очередь сессии следующую страницу; возвращает число новых карточек"""
+    user_data = await state.get_data()
+    if not user_data.get("cursor"):
+        return 0
+    
+    seen = user_history.filter(state.key.user_id)
+    items, cursor = await fetch_next_page(user_data, seen)
+    
+    # Пока шёл запрос, пользователь мог начать заново или листать дальше
+    user_data = await state.get_data()
+    current_state = await state.get_state()
+    if current_state not in (UserState.viewing_recommendations.state, UserState.confirming_restart.state):
+        return 0
+    
+    queued = user_data.get("recommendations", [])
+    queued_entities = {entity_index.entity(ref) for ref in queued} - {None}
+    fresh = [
+        item for item in merge_duplicates(items)
+        if item_ref(item) not in queued and item_ref(item) not in seen
+        and entity_index.entity(item_ref(item)) not in queued_entities
+    ]
+    query = RankQuery.from_selection(user_data["genres"], user_data["mood"], user_data["media_type"])
+    fresh = rank_items(fresh, query, len(fresh), ranking_weights)
+    
+    item_store.put_many({item_ref(item): item for item in fresh})
+    await state.update_data(
+        recommendations=queued + [item_ref(item) for item in fresh],
+        cursor=cursor
+    )
+    return len(fresh)
+
+def next_page(state: FSMContext) -> Awaitable[int]:
+    """Подгрузка следующей страницы; для одной сессии выполняется не больше одной"""
+    return api_client.inflight.do(("next_page", state.key), lambda: load_next_page(state))
+
+def schedule_next_page(state: FSMContext, user_data: Dict[str, Any]):
+    """Подгружает следующую страницу в фоне, если непоказанных карточек осталось мало"""
+    remaining = len(user_data.get("recommendations", [])) - user_data.get("current_index", 0) - 1
+    if not user_data.get("cursor") or remaining > PAGING_PREFETCH_AHEAD:
+        return
+    task = asyncio.ensure_future(next_page(state))
+    paging_tasks.add(task)
+    task.add_done_callback(paging_tasks.discard)
+
+async def show_next_recommendation(message: types.Message, state: FSMContext, intro: str = ""):
+    """Показ следующей карточки очереди; в конце очереди ждёт подгрузку страницы"""
+    user_data = await state.get_data()
+    next_index = user_data.get("current_index", 0) + 1
+    
+    if next_index >= len(user_data.get("recommendations", [])):
+        await next_page(state)
+        user_data = await state.get_data()
+        if next_index >= len(user_data.get("recommendations", [])):
+            # Новых кандидатов больше нет - идём по очереди заново
+            next_index = 0
+    
+    await state.update_data(current_index=next_index)
+    user_data["current_index"] = next_index
+    schedule_next_page(state, user_data)
     
-    # Источник данных
-    source_emoji = {
-        "tmdb": "🎞️", "kinopoisk": "🎬", "kadikama": "💫", "local": "🏠"
-    }.get(media_item.source, "📊")
+    media_item = item_store.get(user_data["recommendations"][next_index])
+    if media_item:
+        await show_recommendation(message, state, media_item, intro)
+    else:
+        await message.answer("Ошибка при загрузке следующего варианта. Попробуйте /start")
+        await state.clear()
+
+async def show_recommendation(message: types.Message, state: FSMContext, media_item: MediaItem,
+                              intro: str = ""):
+    """Показ рекомендации; intro - текст перед карточкой в том же сообщении"""
+    type_emoji = TYPE_EMOJI.get(media_item.type, "🎬")
+    source_emoji = SOURCE_EMOJI.get(media_item.source, "📊")
     
     # Формируем сообщение
-    message_text = (
+    message_text = f"{intro}\n\n" if intro else ""
+    message_text += (
         f"{type_emoji} <b>{media_item.title}</b>\n"
         f"{source_emoji} <i>Источник: {media_item.source.upper()}</i>\n\n"
     )
@@ -696,22 +1474,57 @@ async def show_recommendation(message: types.Message, state: FSMContext, media_i
     if media_item.mood:
         message_text += f"<b>Настроение:</b> {', '.join(media_item.mood)}\n"
     
-    message_text += f"\n<b>Описание:</b>\n{media_item.description}\n\n"
-    message_text += "Что думаете об этом варианте?"
+    description = media_item.description
+    description_header = "\n<b>Описание:</b>\n"
+    footer = "\n\nЧто думаете об этом варианте?"
     
-    await message.answer(message_text, 
-                        parse_mode="HTML",
-                        reply_markup=get_reaction_keyboard())
+    # В inline-режиме карточка заменяет сообщение бота, если тип сообщения тот же
+    editable = INLINE_UI and is_bot_message(message)
+    sent = None
+    if POSTERS_ENABLED and media_item.poster_url:
+        # Подпись к фото короче сообщения - при необходимости сокращаем описание
+        overflow = len(message_text) + len(description_header) + len(description) + len(footer) - CAPTION_LIMIT
+        caption_description = description if overflow <= 0 else description[:max(0, len(description) - overflow - 1)] + "…"
+        caption = f"{message_text}{description_header}{caption_description}{footer}"
+        file_id = poster_pipeline.store.get(item_ref(media_item))
+        if editable and message.photo and file_id:
+            sent = await edit_message(message.edit_media(
+                InputMediaPhoto(media=file_id, caption=caption, parse_mode="HTML"),
+                reply_markup=REACTION_MARKUP
+            )) or None
+        if sent is None:
+            try:
+                sent = await poster_pipeline.send(
+                    item_ref(media_item), media_item.poster_url,
+                    lambda photo: message.answer_photo(photo, caption=caption, parse_mode="HTML",
+                                                       reply_markup=REACTION_MARKUP)
+                )
+            except Exception as e:
+                logger.warning(f"Poster for {item_ref(media_item)} not sent: {e}")
+    
+    if sent is None:
+        text = f"{message_text}{description_header}{description}{footer}"
+        if not (editable and not message.photo and await edit_message(
+                message.edit_text(text, parse_mode="HTML", reply_markup=REACTION_MARKUP))):
+            await message.answer(text, parse_mode="HTML", reply_markup=REACTION_MARKUP)
     
     await state.set_state(UserState.viewing_recommendations)
+    record_history(state, SEEN, item_ref(media_item))
 
 # Обработка реакции на рекомендацию
 @dp.message(UserState.viewing_recommendations)
 async def process_reaction(message: types.Message, state: FSMContext):
+    await handle_reaction(message, state, message.text)
+
+@dp.callback_query(UserState.viewing_recommendations, BOT_MESSAGE, F.data.startswith("r:"))
+async def process_reaction_callback(callback: types.CallbackQuery, state: FSMContext):
+    await callback.answer()
+    await handle_reaction(callback.message, state, inline_ui.reaction(callback.data))
+
+async def handle_reaction(message: types.Message, state: FSMContext, choice: Optional[str]):
     user_data = await state.get_data()
     current_index = user_data.get("current_index", 0)
     recommendation_ids = user_data.get("recommendations", [])
-    recommendations_data = user_data.get("recommendations_data", {})
     recommendations_shown = user_data.get("recommendations_shown", 0)
     
     if not recommendation_ids:
@@ -719,52 +1532,44 @@ async def process_reaction(message: types.Message, state: FSMContext):
         await state.clear()
         return
     
-    if message.text == "🎬 Буду смотреть!":
+    if choice == WATCH_BUTTON:
         # Пользователь выбрал фильм
         current_id = recommendation_ids[current_index]
-        media_item = recommendations_data.get(current_id)
+        media_item = item_store.get(current_id)
         
         if media_item:
-            await message.answer(
+            await reply_or_edit(
+                message,
                 f"🎉 Отличный выбор!\n\n"
                 f"<b>{media_item.title}</b> - прекрасный вариант для вечера!\n\n"
                 f"Приятного просмотра! 🍿\n\n"
                 f"Если захотите подобрать что-то ещё - нажмите /start",
-                parse_mode="HTML",
-                reply_markup=ReplyKeyboardRemove()
+                reply_markup=CLOSE_MARKUP
             )
         
-        # Сохраняем историю просмотров (в реальном проекте - в БД)
+        # Сохраняем выбор в историю пользователя
+        record_history(state, CHOSEN, current_id)
         logger.info(f"User selected: {media_item.title if media_item else 'Unknown'}")
         await state.clear()
         return
     
-    elif message.text == "➡️ Следующий вариант":
+    elif choice == NEXT_BUTTON:
         # Следующий вариант
+        record_history(state, REJECTED, recommendation_ids[current_index])
         recommendations_shown += 1
         await state.update_data(recommendations_shown=recommendations_shown)
         
         # Проверяем лимит в 3 показа
         if recommendations_shown >= 3:
-            await message.answer(
+            await reply_or_edit(
+                message,
                 "🤔 Вы точно хотите посмотреть что-то сегодня?",
-                reply_markup=get_confirm_restart_keyboard()
+                reply_markup=CONFIRM_RESTART_MARKUP
             )
             await state.set_state(UserState.confirming_restart)
             return
         
-        # Следующий индекс
-        next_index = (current_index + 1) % len(recommendation_ids)
-        await state.update_data(current_index=next_index)
-        
-        next_id = recommendation_ids[next_index]
-        media_item = recommendations_data.get(next_id)
-        
-        if media_item:
-            await show_recommendation(message, state, media_item)
-        else:
-            await message.answer("Ошибка при загрузке следующего варианта. Попробуйте /start")
-            await state.clear()
+        await show_next_recommendation(message, state)
     
     else:
         await message.answer("Пожалуйста, используйте кнопки для ответа!")
@@ -772,42 +1577,37 @@ async def process_reaction(message: types.Message, state: FSMContext):
 # Подтверждение перезапуска
 @dp.message(UserState.confirming_restart)
 async def process_restart_confirmation(message: types.Message, state: FSMContext):
-    if message.text == "Да, ищу дальше!":
-        # Начинаем показ заново
-        user_data = await state.get_data()
-        recommendation_ids = user_data.get("recommendations", [])
-        
-        if recommendation_ids:
-            await state.update_data(
-                current_index=0,
-                recommendations_shown=0
-            )
-            
-            first_id = recommendation_ids[0]
-            media_item = user_data.get("recommendations_data", {}).get(first_id)
-            
-            if media_item:
-                await message.answer(
-                    "Отлично! Продолжаем поиск с теми же параметрами:",
-                    reply_markup=ReplyKeyboardRemove()
-                )
-                await show_recommendation(message, state, media_item)
-            else:
-                await message.answer("Ошибка. Попробуйте начать заново: /start")
-                await state.clear()
+    await handle_restart_confirmation(message, state, message.text)
+
+@dp.callback_query(UserState.confirming_restart, BOT_MESSAGE, F.data.startswith("r:"))
+async def process_restart_callback(callback: types.CallbackQuery, state: FSMContext):
+    await callback.answer()
+    await handle_restart_confirmation(callback.message, state, inline_ui.reaction(callback.data))
+
+async def handle_restart_confirmation(message: types.Message, state: FSMContext, choice: Optional[str]):
+    if choice == RESTART_YES_BUTTON:
+        # Продолжаем с того же места: очередь подгружается новыми страницами
+        await state.update_data(recommendations_shown=0)
+        await show_next_recommendation(message, state, intro="Отлично! Продолжаем поиск с теми же параметрами:")
     
-    elif message.text == "Нет, не сегодня":
-        await message.answer(
+    elif choice == RESTART_NO_BUTTON:
+        await reply_or_edit(
+            message,
             "😔 Похоже, мы с вами не смогли в этот раз подобрать что-то подходящее.\n\n"
             "Не расстраивайтесь! Возможно, в другой раз настроение будет другим.\n\n"
             "Если всё же решите посмотреть что-то - просто нажмите /start",
-            reply_markup=ReplyKeyboardRemove()
+            reply_markup=CLOSE_MARKUP
         )
         await state.clear()
     
     else:
         await message.answer("Пожалуйста, используйте кнопки для ответа!")
 
+@dp.callback_query()
+async def stale_callback(callback: types.CallbackQuery):
+    """Кнопки старых сообщений: убираем часики и подсказываем начать заново"""
+    await callback.answer("Эта кнопка уже не действует. Нажмите /start")
+
 # Обработка неизвестных сообщений
 @dp.message()
 async def unknown_message(message: types.Message):
@@ -818,6 +1618,230 @@ async def unknown_message(message: types.Message):
     )
 
 # Запуск бота
+async def expire_sessions():
+    """Периодически удаляет простаивающие сессии FSM"""
+    while True:
+        await asyncio.sleep(FSM_CLEANUP_INTERVAL)
+        try:
+            removed = storage.expire()
+            if removed:
+                logger.info(f"Expired {removed} idle FSM sessions")
+        except Exception as e:
+            logger.error(f"FSM cleanup error: {e}")
+
+# Фоновые задачи процесса: запускаются и останавливаются вместе с диспетчером
+background_tasks = []
+
+@dp.startup()
+async def on_startup():
+    """Открывает пул соединений и запускает фоновые задачи"""
+    await api_client.start()
+    
+    # Среди нескольких обработчиков общий кеш прогревает только первый
+    # Без сетки прогрев всё равно обновляет популярные ключи
+    if PREFETCH_ENABLED and not WORKER_ID:
+        background_tasks.append(asyncio.create_task(prefetcher.run()))
+    
+    if hasattr(storage, "expire"):
+        background_tasks.append(asyncio.create_task(expire_sessions()))
+    
+    if API_CONFIG["tmdb_api_key"] and API_CONFIG["tmdb_api_key"] != "ВАШ_TMDB_API_KEY":
+        background_tasks.append(asyncio.create_task(trending_board.run()))
+    
+    if METRICS_PORT:
+        global metrics_runner
+        port = METRICS_PORT + (WORKER_ID or 0)
+        try:
+            metrics_runner = await start_metrics_server(metrics_registry, METRICS_HOST, port)
+        except OSError as e:
+            logger.warning(f"⚠️ Metrics server not started on {METRICS_HOST}:{port}: {e}")
+        background_tasks.append(asyncio.create_task(
+            monitor_loop_lag(loop_lag, loop_lag_histogram, LOOP_LAG_INTERVAL)
+        ))
+
+@dp.shutdown()
+async def on_shutdown():
+    """Останавливает фоновые задачи и закрывает хранилища и API клиент.
+    Хранилище FSM закрывает сам диспетчер"""
+    # Останавливаем фоновые задачи
+    for task in (*background_tasks, *paging_tasks):
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    background_tasks.clear()
+    await prefetcher.stop()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    
+    # Закрываем хранилища
+    item_store.close()
+    entity_index.close()
+    user_history.close()
+    poster_pipeline.store.close()
+    
+    # Закрываем сессию API клиента
+    await api_client.close()
+    if shared_cache:
+        await shared_cache.close()
+    logger.info(f"Cache stats: {media_cache.stats()}")
+    logger.info(f"Detail cache stats: {detail_cache.stats()}")
+    logger.info(f"Request coalescing stats: {api_client.inflight.stats()}")
+    logger.info(f"Trending stats: {trending_board.stats()}")
+    logger.info(f"Poster stats: {poster_pipeline.stats()}")
+    logger.info(f"Telegram send limiter: {send_limiter.stats()}")
+    
+    # Сохраняем счётчики квот
+    for name, limiter in rate_limiters.items():
+        limiter.flush()
+        logger.info(f"Rate limiter {name}: {limiter.stats()}")
+        logger.info(f"Circuit breaker {name}: {circuit_breakers[name].stats()}")
+
+# Режим webhook
+async def health(request: web.Request) -> web.Response:
+    """Проверка живости для балансировщика"""
+    return web.json_response({"status": "ok", "mode": BOT_MODE})
+
+async def on_webhook_startup(app: web.Application):
+    await dp.emit_startup(bot=bot)
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info(f"Webhook set: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+
+async def on_webhook_cleanup(app: web.Application):
+    # Вызывается после того, как aiohttp дождался уже принятых обновлений
+    await dp.emit_shutdown(bot=bot)
+    await bot.session.close()
+
+def create_webhook_app() -> web.Application:
+    """aiohttp-приложение: обновления от Telegram и проверка живости"""
+    app = web.Application()
+    handler = SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None, handle_in_background=False
+    )
+    # Обновление обрабатывается в рамках запроса, поэтому при остановке aiohttp
+    # дожидается незавершённых. handler.register() не используется: он закрывает
+    # сессию бота в on_shutdown, то есть до этого ожидания
+    app.router.add_post(WEBHOOK_PATH, handler.handle)
+    app.router.add_get(HEALTH_PATH, health)
+    app.on_startup.append(on_webhook_startup)
+    app.on_cleanup.append(on_webhook_cleanup)
+    return app
+
+async def run_webhook():
+    if not WEBHOOK_SECRET:
+        logger.warning("⚠️ WEBHOOK_SECRET не установлен: запросы к webhook не проверяются")
+    
+    runner = web.AppRunner(create_webhook_app(), shutdown_timeout=WEBHOOK_SHUTDOWN_TIMEOUT)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT)
+    await site.start()
+    logger.info(f"Webhook server listening on {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+    
+    # SIGTERM от оркестратора - штатная остановка, как и Ctrl+C
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+# Несколько процессов-обработчиков
+async def run_router():
+    """Запускает обработчики и раздаёт им обновления, полученные через polling или webhook"""
+    # Секрет между маршрутизатором и обработчиками, не связанный с секретом Telegram
+    worker_secret = secrets.token_urlsafe(32)
+    worker_env = {"WEBHOOK_SECRET": worker_secret, "WORKERS": str(WORKERS)}
+    if not SHARED_CACHE:
+        worker_env["SHARED_CACHE"] = f"sqlite:///{os.path.join(DATA_DIR, 'cache.db')}"
+    
+    processes = spawn_workers(os.path.abspath(__file__), WORKERS, WORKER_HOST, WORKER_BASE_PORT, worker_env)
+    worker_urls = [f"http://{WORKER_HOST}:{WORKER_BASE_PORT + i}" for i in range(WORKERS)]
+    router = UpdateRouter([url + WEBHOOK_PATH for url in worker_urls], secret=worker_secret)
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    
+    runner = None
+    polling_task = None
+    try:
+        await router.wait_ready([url + HEALTH_PATH for url in worker_urls])
+        logger.info(f"Router started with {WORKERS} workers")
+        
+        if BOT_MODE == "webhook":
+            runner = web.AppRunner(create_router_app(router))
+            await runner.setup()
+            await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+        else:
+            polling_task = asyncio.create_task(poll_updates(router))
+        await stop.wait()
+    finally:
+        # Сначала перестаём принимать обновления, затем досылаем принятые
+        if polling_task:
+            polling_task.cancel()
+            await asyncio.gather(polling_task, return_exceptions=True)
+        if runner:
+            await runner.cleanup()
+        await router.close(WEBHOOK_SHUTDOWN_TIMEOUT)
+        logger.info(f"Router stats: {router.stats()}")
+        await loop.run_in_executor(None, stop_workers, processes, WEBHOOK_SHUTDOWN_TIMEOUT)
+        await bot.session.close()
+
+async def poll_updates(router: UpdateRouter):
+    """Long polling в маршрутизаторе: обновления не обрабатываются, а раздаются"""
+    offset = None
+    allowed_updates = dp.resolve_used_update_types()
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Polling error: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            router.route(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+            offset = update.update_id + 1
+
+def create_router_app(router: UpdateRouter) -> web.Application:
+    """Webhook маршрутизатора: обновление сразу ставится в очередь своего чата"""
+    async def receive(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        router.route(await request.json())
+        return web.Response()
+    
+    async def router_health(request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok", "mode": "router", "workers": WORKERS, **router.stats()})
+    
+    async def on_router_startup(app: web.Application):
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+    
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, receive)
+    app.router.add_get(HEALTH_PATH, router_health)
+    app.on_startup.append(on_router_startup)
+    return app
+
 async def main():
     """Основная функция запуска"""
     print("="*60)
@@ -825,11 +1849,12 @@ async def main():
     print("📱 Перейдите в Telegram и найдите вашего бота")
     print("="*60)
     
-    try:
+    if WORKERS > 1 and WORKER_ID is None:
+        await run_router()
+    elif BOT_MODE == "webhook":
+        await run_webhook()
+    else:
         await dp.start_polling(bot)
-    finally:
-        # Закрываем сессию API клиента
-        await api_client.close()
 
 if __name__ == "__main__":
     try:
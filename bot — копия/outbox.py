@@ -0,0 +1,88 @@
+"""Исходящие сообщения в темпе, который допускает Telegram.
+
+Middleware сессии бота: каждый запрос с chat_id (отправка, правка)
+ждёт токен в ведре своего чата и в общем ведре бота, поэтому всплеск
+ответов растягивается во времени, а не упирается в 429. Если Telegram
+всё же ответил RetryAfter, чат не получает сообщений до истечения паузы,
+а запрос повторяется после неё.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from cache import TTLCache
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class SendLimiter(BaseRequestMiddleware):
+    """Лимиты Telegram на чат (личный и групповой) и на бота + повтор после flood wait"""
+
+    def __init__(self, chat_rate: float = 1.0, chat_burst: float = 3.0, group_rate: float = 20 / 60,
+                 global_rate: float = 30.0, global_burst: Optional[float] = None,
+                 max_retries: int = 3, max_chats: int = 10000):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        # Ведро чата, простоявшего минуту, снова полное - его можно забыть
+        self._buckets = TTLCache(maxsize=max_chats, ttl=60)
+        self._blocked_until: Dict[int, float] = {}
+        self.throttled = 0
+        self.flood_waits = 0
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательный id - группа или канал: там лимит строже
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, 1.0)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        # Срок хранения отсчитывается от последней отправки
+        self._buckets.set(chat_id, bucket)
+        return bucket
+
+    async def _acquire(self, chat_id: int) -> None:
+        bucket = self._bucket(chat_id)
+        while True:
+            now = time.monotonic()
+            wait = self._blocked_until.get(chat_id, 0.0) - now
+            if wait <= 0:
+                # Между проверкой и взятием токенов нет await - гонки нет
+                wait = max(bucket.delay(), self.global_bucket.delay())
+                if not wait:
+                    bucket.try_acquire()
+                    self.global_bucket.try_acquire()
+                    self._blocked_until.pop(chat_id, None)
+                    return
+            self.throttled += 1
+            await asyncio.sleep(wait)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if not isinstance(chat_id, int):
+            # Ответы на callback и запросы без чата не ждут
+            return await make_request(bot, method)
+
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat_id)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.flood_waits += 1
+                if attempt == self.max_retries:
+                    raise
+                until = time.monotonic() + e.retry_after
+                self._blocked_until[chat_id] = max(self._blocked_until.get(chat_id, 0.0), until)
+                logger.warning(f"Flood wait {e.retry_after}s for chat {chat_id} "
+                               f"on {type(method).__name__}, retrying")
+
+    def stats(self) -> Dict[str, int]:
+        return {"throttled": self.throttled, "flood_waits": self.flood_waits, "chats": len(self._buckets)}
@@ -0,0 +1,125 @@
+"""Постеры карточек: одна загрузка в Telegram на постер.
+
+Картинка скачивается и отправляется в Telegram один раз, после этого
+сохраняется file_id из ответа, и все следующие отправки - любому
+пользователю и из любого процесса - идут по file_id без загрузки.
+Одновременные первые показы одного постера ждут одну загрузку.
+Если установлен Pillow, крупные картинки перед загрузкой уменьшаются.
+"""
+import asyncio
+import io
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Union
+
+import aiohttp
+from aiogram.types import BufferedInputFile, Message
+
+from cache import TTLCache
+from fsm_storage import ItemStore
+from singleflight import SingleFlight
+
+try:
+    from PIL import Image
+except ImportError:  # без Pillow постеры отправляются как есть
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Лимит Telegram на загрузку фото - 10 МБ
+MAX_POSTER_BYTES = 10 * 1024 * 1024
+_CHUNK_SIZE = 64 * 1024
+
+Photo = Union[str, BufferedInputFile]
+SendPhoto = Callable[[Photo], Awaitable[Message]]
+
+
+def downscale(data: bytes, max_side: int, quality: int = 85) -> bytes:
+    """Уменьшает картинку до max_side по большей стороне (JPEG); без Pillow - как есть"""
+    if Image is None or not max_side:
+        return data
+    with Image.open(io.BytesIO(data)) as image:
+        if max(image.size) <= max_side:
+            return data
+        image.thumbnail((max_side, max_side))
+        output = io.BytesIO()
+        image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+
+class PosterPipeline:
+    """Отправка постеров: file_id из хранилища или одна загрузка на постер"""
+
+    def __init__(self, store: ItemStore, get_session: Callable[[], Awaitable[aiohttp.ClientSession]],
+                 max_side: int = 0, timeout: float = 10.0, failure_ttl: float = 3600):
+        self.store = store
+        self.get_session = get_session
+        self.max_side = max_side
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.inflight = SingleFlight()
+        # Постеры, которые не удалось скачать, какое-то время не пробуем
+        self._failed = TTLCache(maxsize=10000, ttl=failure_ttl)
+        self.counts: Dict[str, int] = {"cached": 0, "uploaded": 0, "failed": 0}
+
+    async def _download(self, url: str) -> Optional[bytes]:
+        session = await self.get_session()
+        async with session.get(url, timeout=self.timeout) as response:
+            if response.status != 200:
+                logger.warning(f"Poster {url}: HTTP {response.status}")
+                return None
+            if (response.content_length or 0) > MAX_POSTER_BYTES:
+                logger.warning(f"Poster {url} is larger than {MAX_POSTER_BYTES} bytes")
+                return None
+            # Тело читается до конца: read(n) отдал бы только то, что уже пришло
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(_CHUNK_SIZE):
+                data += chunk
+                if len(data) > MAX_POSTER_BYTES:
+                    logger.warning(f"Poster {url} is larger than {MAX_POSTER_BYTES} bytes")
+                    return None
+        data = bytes(data)
+        if Image is not None and self.max_side:
+            data = await asyncio.to_thread(downscale, data, self.max_side)
+        return data
+
+    async def send(self, ref: str, url: Optional[str], send_photo: SendPhoto) -> Optional[Message]:
+        """Отправляет постер через send_photo(file_id или файл); None - постера нет
+        или он не отправился (тогда карточку нужно отправить текстом)"""
+        if not url or self._failed.get(ref):
+            return None
+
+        file_id = self.store.get(ref)
+        if file_id:
+            self.counts["cached"] += 1
+            return await send_photo(file_id)
+
+        uploaded: Optional[Message] = None
+
+        async def upload() -> Optional[str]:
+            nonlocal uploaded
+            try:
+                data = await self._download(url)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError, ValueError) as e:
+                logger.warning(f"Poster {url} download failed: {e!r}")
+                data = None
+            if not data:
+                self._failed.set(ref, True)
+                self.counts["failed"] += 1
+                return None
+            uploaded = await send_photo(BufferedInputFile(data, filename=f"{ref.replace(':', '_')}.jpg"))
+            self.counts["uploaded"] += 1
+            if uploaded.photo:
+                self.store.put_many({ref: uploaded.photo[-1].file_id})
+                return uploaded.photo[-1].file_id
+            return None
+
+        # Загружает постер тот, кто пришёл первым; остальные ждут его file_id
+        file_id = await self.inflight.do(ref, upload)
+        if uploaded is not None:
+            return uploaded
+        if file_id:
+            self.counts["cached"] += 1
+            return await send_photo(file_id)
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.counts, **self.inflight.stats())
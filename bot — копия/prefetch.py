@@ -0,0 +1,106 @@
+"""Фоновый прогрев и обновление кеша ответов внешних API"""
+import asyncio
+import logging
+import random
+from collections import Counter
+from typing import Awaitable, Callable, Hashable, Iterable, List, Optional, Set
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+Fetcher = Callable[[Hashable], Awaitable[Optional[list]]]
+
+
+class CachePrefetcher:
+    """Держит кеш тёплым: периодически обновляет фиксированную сетку запросов
+    (жанр x тип) и самые популярные ключи, а также по требованию обновляет
+    устаревшие записи в фоне (stale-while-revalidate).
+
+    Запросы к API идут не чаще rate раз в секунду, со случайной задержкой
+    до jitter секунд, чтобы не попадать в синхронные пики.
+    """
+
+    def __init__(self, cache: TTLCache, fetch: Fetcher, base_keys: Iterable[Hashable] = (),
+                 interval: float = 3000, rate: float = 2.0, jitter: float = 0.5,
+                 popular_limit: int = 50):
+        self.cache = cache
+        self.fetch = fetch
+        self.base_keys: List[Hashable] = list(dict.fromkeys(base_keys))
+        self.interval = interval
+        self.min_delay = 1.0 / rate if rate > 0 else 0.0
+        self.jitter = jitter
+        self.popular_limit = popular_limit
+
+        self.requests: Counter = Counter()
+        self._inflight: Set[Hashable] = set()
+        self._background: Set[asyncio.Task] = set()
+        self._rate_lock = asyncio.Lock()
+        self.refreshed = 0
+        self.failed = 0
+
+    def record_request(self, key: Hashable) -> None:
+        """Учитывает пользовательский запрос для выбора популярных ключей"""
+        self.requests[key] += 1
+
+    def schedule_refresh(self, key: Hashable) -> None:
+        """Обновить запись в фоне (если она уже не обновляется)"""
+        if key in self._inflight:
+            return
+        task = asyncio.create_task(self.refresh(key))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def refresh(self, key: Hashable) -> bool:
+        if key in self._inflight:
+            return False
+        self._inflight.add(key)
+        try:
+            await self._throttle()
+            items = await self.fetch(key)
+            if not items:
+                # Пустой ответ не затирает старые данные
+                self.failed += 1
+                return False
+            self.cache.set(key, items)
+            self.refreshed += 1
+            return True
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Prefetch error for {key}: {e}")
+            return False
+        finally:
+            self._inflight.discard(key)
+
+    async def _throttle(self) -> None:
+        async with self._rate_lock:
+            await asyncio.sleep(self.min_delay + random.uniform(0, self.jitter))
+
+    def keys_to_refresh(self) -> List[Hashable]:
+        popular = [key for key, _ in self.requests.most_common(self.popular_limit)]
+        return list(dict.fromkeys(self.base_keys + popular))
+
+    async def run_once(self) -> None:
+        keys = self.keys_to_refresh()
+        started = asyncio.get_running_loop().time()
+        for key in keys:
+            await self.refresh(key)
+        elapsed = asyncio.get_running_loop().time() - started
+        logger.info(f"Prefetch pass: {len(keys)} keys in {elapsed:.1f}s "
+                    f"(refreshed={self.refreshed}, failed={self.failed})")
+
+    async def run(self) -> None:
+        """Бесконечный цикл прогрева; останавливается отменой задачи"""
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Prefetch pass failed: {e}")
+            await asyncio.sleep(self.interval + random.uniform(0, self.interval * 0.1))
+
+    async def stop(self) -> None:
+        for task in list(self._background):
+            task.cancel()
+        await asyncio.gather(*self._background, return_exceptions=True)
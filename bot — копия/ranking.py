@@ -0,0 +1,160 @@
+"""Ранжирование кандидатов: векторный расчёт оценки и выбор top-k"""
+import heapq
+import math
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from vocabulary import GENRE_VOCAB, MOOD_VOCAB, TYPE_CODES, UNKNOWN_TYPE_CODE
+
+# Маски запроса состоят только из фиксированных значений словаря,
+# поэтому для пересечения хватает младших 64 бит маски карточки
+_LOW_BITS = (1 << 64) - 1
+# Нормировка числа голосов: столько голосов дают максимальный вклад
+_VOTES_REFERENCE = math.log1p(1_000_000)
+_OLDEST_YEAR = 1950
+
+
+@dataclass(frozen=True)
+class RankingWeights:
+    genre: float = 3.0
+    mood: float = 2.0
+    type: float = 1.5
+    rating: float = 1.0
+    votes: float = 0.5
+    recency: float = 0.5
+
+    @property
+    def total(self) -> float:
+        """Максимально возможная оценка"""
+        return self.genre + self.mood + self.type + self.rating + self.votes + self.recency
+
+
+@dataclass(frozen=True)
+class RankQuery:
+    genre_mask: int
+    mood_mask: int
+    type_code: int  # -1 - любой тип
+
+    @classmethod
+    def from_selection(cls, genres: Iterable[str], moods: Iterable[str], media_type: Optional[str]) -> "RankQuery":
+        return cls(
+            genre_mask=GENRE_VOCAB.mask(genres),
+            mood_mask=MOOD_VOCAB.mask(moods),
+            type_code=-1 if media_type in (None, "любой") else TYPE_CODES.get(media_type, -2),
+        )
+
+
+def _popcount(values: np.ndarray) -> np.ndarray:
+    return np.bitwise_count(values).astype(np.float32)
+
+
+class FeatureMatrix:
+    """Признаки кандидатов в виде столбцов NumPy.
+
+    Для каталога строится один раз при старте прямо из столбцов снимка,
+    а карточки создаются только для выбранных строк; для ответов API -
+    из карточек на каждый запрос (их там десятки).
+    """
+
+    def __init__(self, genre: np.ndarray, mood: np.ndarray, type: np.ndarray, rating: np.ndarray,
+                 votes: np.ndarray, year: np.ndarray, item: Callable[[int], object]):
+        self.genre = genre.astype(np.uint64, copy=False)
+        self.mood = mood.astype(np.uint64, copy=False)
+        self.type = type.astype(np.int8, copy=False)
+        self.rating = rating.astype(np.float32, copy=False)
+        self.votes = votes.astype(np.float32, copy=False)
+        self.year = year.astype(np.float32, copy=False)
+        self._item = item
+
+        # Слагаемые, не зависящие от запроса, считаются заранее
+        self._rating_norm = np.clip(self.rating / 10.0, 0.0, 1.0)
+        self._votes_norm = np.clip(np.log1p(self.votes) / _VOTES_REFERENCE, 0.0, 1.0)
+        current_year = datetime.now().year
+        self._recency = np.clip((self.year - _OLDEST_YEAR) / (current_year - _OLDEST_YEAR), 0.0, 1.0)
+
+    @classmethod
+    def from_items(cls, items: Sequence) -> "FeatureMatrix":
+        items = list(items)
+        n = len(items)
+        return cls(
+            genre=np.fromiter((i.genre_mask & _LOW_BITS for i in items), dtype=np.uint64, count=n),
+            mood=np.fromiter((i.mood_mask & _LOW_BITS for i in items), dtype=np.uint64, count=n),
+            type=np.fromiter((TYPE_CODES.get(i.type, UNKNOWN_TYPE_CODE) for i in items), dtype=np.int8, count=n),
+            rating=np.fromiter((float(i.rating or 0) for i in items), dtype=np.float32, count=n),
+            votes=np.fromiter((float(getattr(i, "votes", 0) or 0) for i in items), dtype=np.float32, count=n),
+            year=np.fromiter((int(i.year or 0) for i in items), dtype=np.float32, count=n),
+            item=items.__getitem__,
+        )
+
+    @classmethod
+    def from_catalog(cls, catalog, item: Callable[[int], object]) -> "FeatureMatrix":
+        """Признаки из столбцов снимка каталога; item(row) - карточка строки"""
+        def column(name):
+            fmt, data = catalog.column(name)
+            return np.frombuffer(data, dtype=np.dtype("<" + fmt))
+
+        return cls(
+            genre=column("genre_mask"), mood=column("mood_mask"), type=column("type_code"),
+            rating=column("rating"), votes=column("votes"), year=column("year"), item=item,
+        )
+
+    def __len__(self) -> int:
+        return len(self.rating)
+
+    def scores(self, query: RankQuery, weights: RankingWeights,
+               rows: Optional[np.ndarray] = None) -> np.ndarray:
+        def column(values):
+            return values if rows is None else values[rows]
+
+        score = (weights.rating * column(self._rating_norm)
+                 + weights.votes * column(self._votes_norm)
+                 + weights.recency * column(self._recency))
+
+        if query.genre_mask:
+            wanted = bin(query.genre_mask).count("1")
+            score += weights.genre * _popcount(column(self.genre) & np.uint64(query.genre_mask)) / wanted
+        if query.mood_mask:
+            wanted = bin(query.mood_mask).count("1")
+            score += weights.mood * _popcount(column(self.mood) & np.uint64(query.mood_mask)) / wanted
+        if query.type_code == -1:
+            score += weights.type
+        else:
+            score += weights.type * (column(self.type) == query.type_code)
+        return score
+
+    def top_k(self, query: RankQuery, k: int, weights: RankingWeights,
+              rows: Optional[Sequence[int]] = None) -> List:
+        """k лучших кандидатов по убыванию оценки (rows - ограничить набор строк)"""
+        row_index = None if rows is None else np.asarray(rows, dtype=np.int64)
+        score = self.scores(query, weights, row_index)
+        if not len(score):
+            return []
+
+        k = min(k, len(score))
+        # argpartition выбирает k лучших за O(n), сортируются только они
+        best = np.argpartition(-score, k - 1)[:k]
+        best = best[np.argsort(-score[best], kind="stable")]
+        if row_index is not None:
+            best = row_index[best]
+        return [self._item(int(i)) for i in best]
+
+
+def rank_items(items: Sequence, query: RankQuery, k: int, weights: RankingWeights) -> List:
+    """Ранжирование небольшого списка (ответы API): оценка векторно, top-k через кучу"""
+    if not items:
+        return []
+    score = FeatureMatrix.from_items(items).scores(query, weights)
+    best = heapq.nlargest(k, range(len(items)), key=score.__getitem__)
+    return [items[i] for i in best]
+
+
+def best_candidate(items: Sequence, query: RankQuery, weights: RankingWeights) -> Tuple[Optional[object], float]:
+    """Лучший кандидат и его оценка как доля от максимальной (0..1)"""
+    if not items:
+        return None, 0.0
+    score = FeatureMatrix.from_items(items).scores(query, weights)
+    best = int(np.argmax(score))
+    return items[best], float(score[best]) / weights.total if weights.total else 0.0
@@ -0,0 +1,190 @@
+"""Клиентские лимиты запросов к внешним API: token bucket + дневная квота"""
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def parse_retry_after(value: Optional[str], default: float = 1.0) -> float:
+    """Retry-After в секундах: число секунд или HTTP-дата"""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+
+def _today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        if self.rate <= 0:
+            return True
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    def delay(self, tokens: float = 1) -> float:
+        """Через сколько секунд наберётся нужное количество токенов"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        return max(0.0, (tokens - self._tokens) / self.rate)
+
+
+class QuotaStore:
+    """Счётчики дневных квот в JSON-файле, переживают перезапуск"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.data: Dict[str, Dict] = {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Quota state {path} is unreadable, starting from zero: {e}")
+
+    def used(self, provider: str, day: str) -> int:
+        entry = self.data.get(provider, {})
+        return entry.get("used", 0) if entry.get("day") == day else 0
+
+    def set_used(self, provider: str, day: str, used: int) -> None:
+        self.data[provider] = {"day": day, "used": used}
+
+    def save(self) -> None:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Quota state save error: {e}")
+
+
+class ProviderLimiter:
+    """Лимитер одного провайдера.
+
+    acquire() ждёт токен не дольше max_wait; если ждать дольше, квота на день
+    исчерпана или провайдер попросил подождать (429 + Retry-After),
+    возвращает False, и вызывающий код использует кеш/локальные данные.
+    """
+
+    def __init__(self, name: str, rate: float, burst: Optional[float] = None, daily_quota: int = 0,
+                 max_wait: float = 1.0, store: Optional[QuotaStore] = None, save_every: int = 10):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.daily_quota = daily_quota
+        self.max_wait = max_wait
+        self.store = store
+        self.save_every = save_every
+
+        self._day = _today()
+        self.used = store.used(name, self._day) if store else 0
+        self._unsaved = 0
+        self._blocked_until = 0.0
+        self.throttled = 0
+        self.rejected = 0
+
+    @property
+    def remaining(self) -> Optional[int]:
+        """Остаток дневной квоты (None - квоты нет)"""
+        if not self.daily_quota:
+            return None
+        self._roll_day()
+        return max(0, self.daily_quota - self.used)
+
+    def has_budget(self, reserve: float = 0.0) -> bool:
+        """Есть ли квота сверх доли reserve, отложенной для пользовательских запросов"""
+        remaining = self.remaining
+        if self._blocked_until > time.monotonic():
+            return False
+        return remaining is None or remaining > self.daily_quota * reserve
+
+    def _roll_day(self) -> None:
+        today = _today()
+        if today != self._day:
+            self._day = today
+            self.used = 0
+
+    def _consume(self) -> None:
+        self.used += 1
+        if self.store:
+            self.store.set_used(self.name, self._day, self.used)
+            self._unsaved += 1
+            if self._unsaved >= self.save_every:
+                self.flush()
+
+    def flush(self) -> None:
+        if self.store and self._unsaved:
+            self.store.save()
+            self._unsaved = 0
+
+    async def acquire(self) -> bool:
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            if self.remaining == 0:
+                self.rejected += 1
+                return False
+
+            now = time.monotonic()
+            wait = max(self._blocked_until - now, 0.0)
+            if not wait:
+                if self.bucket.try_acquire():
+                    self._consume()
+                    return True
+                wait = self.bucket.delay()
+
+            if now + wait > deadline:
+                self.rejected += 1
+                return False
+            self.throttled += 1
+            await asyncio.sleep(wait)
+
+    def retry_after(self, value: Optional[str]) -> float:
+        """Учитывает 429: до истечения Retry-After запросы не отправляются"""
+        seconds = parse_retry_after(value)
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        logger.warning(f"{self.name}: rate limited by upstream, pausing for {seconds:.0f}s")
+        return seconds
+
+    def stats(self) -> Dict:
+        return {
+            "used_today": self.used,
+            "remaining": self.remaining,
+            "throttled": self.throttled,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,88 @@
+"""Повторы с экспоненциальной задержкой и circuit breaker для внешних API"""
+import logging
+import random
+import time
+from typing import Callable, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class RetryPolicy:
+    """Ограниченное число попыток с экспоненциальной задержкой и full jitter"""
+
+    def __init__(self, attempts: int = 3, base_delay: float = 0.2, max_delay: float = 2.0):
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        """Пауза перед попыткой номер attempt + 1 (attempt считается с нуля)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Размыкатель для одного провайдера.
+
+    После failure_threshold неудач подряд провайдер считается недоступным
+    на cooldown секунд: запросы к нему не отправляются вовсе. Затем
+    пропускается один пробный запрос - при успехе цепь замыкается,
+    при неудаче снова размыкается.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, cooldown: float = 30.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._clock = clock
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.short_circuited = 0
+
+    def allow_request(self) -> Tuple[bool, bool]:
+        """(можно ли отправить запрос, пробный ли это запрос)"""
+        if self.state == self.CLOSED:
+            return True, False
+
+        if self.state == self.OPEN and self._clock() - self._opened_at >= self.cooldown:
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True, True
+
+        self.short_circuited += 1
+        return False, False
+
+    def release(self) -> None:
+        """Пробный запрос завершился без результата (например, не хватило квоты).
+        Вызывает только тот, кому allow_request() выдал пробный запрос"""
+        self._probe_in_flight = False
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.info(f"{self.name}: circuit closed")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"{self.name}: circuit opened for {self.cooldown:.0f}s "
+                               f"after {self.failures} failures")
+            self.state = self.OPEN
+            self._opened_at = self._clock()
+            self._probe_in_flight = False
+
+    def stats(self) -> Dict:
+        return {"state": self.state, "failures": self.failures, "short_circuited": self.short_circuited}
@@ -0,0 +1,95 @@
+"""Общий для нескольких процессов кеш ответов API.
+
+Второй уровень после TTLCache процесса: промах в памяти проверяется здесь
+до запроса к API, а свежий ответ API записывается сюда, чтобы его получили
+и остальные процессы. Бэкенд выбирается адресом: sqlite:///путь (процессы
+на одной машине) или redis://... (если установлен пакет redis).
+"""
+import json
+import time
+from typing import Any, Callable, Hashable, Optional
+
+from sqlite_db import connect
+
+# Как часто (в записях) удалять из SQLite истёкшие ответы
+PURGE_EVERY = 1000
+
+
+def _key(key: Hashable) -> str:
+    return json.dumps(key, ensure_ascii=False, separators=(",", ":"))
+
+
+class SQLiteCache:
+    """Кеш в файле SQLite (WAL): читать и писать могут несколько процессов"""
+
+    def __init__(self, path: str, encode: Callable[[Any], Any], decode: Callable[[Any], Any]):
+        self._encode = encode
+        self._decode = decode
+        self._writes = 0
+        self._db = connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL)"
+        )
+
+    async def get(self, key: Hashable) -> Optional[Any]:
+        row = self._db.execute(
+            "SELECT value FROM cache WHERE key = ? AND expires_at > ?", (_key(key), time.time())
+        ).fetchone()
+        return self._decode(json.loads(row[0])) if row else None
+
+    async def set(self, key: Hashable, value: Any, ttl: float) -> None:
+        now = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (_key(key), json.dumps(self._encode(value), ensure_ascii=False, separators=(",", ":")), now + ttl)
+        )
+        self._writes += 1
+        if self._writes % PURGE_EVERY == 0:
+            self._db.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+
+    async def close(self) -> None:
+        self._db.close()
+
+
+class RedisCache:
+    """Кеш в Redis: общий и для процессов на разных машинах"""
+
+    def __init__(self, url: str, encode: Callable[[Any], Any], decode: Callable[[Any], Any],
+                 prefix: str = "movie_bot:cache:"):
+        try:
+            from redis.asyncio import Redis
+        except ImportError as e:
+            raise ValueError("Для SHARED_CACHE=redis нужен пакет redis") from e
+        self._redis = Redis.from_url(url)
+        self._encode = encode
+        self._decode = decode
+        self._prefix = prefix
+
+    async def get(self, key: Hashable) -> Optional[Any]:
+        raw = await self._redis.get(self._prefix + _key(key))
+        return self._decode(json.loads(raw)) if raw else None
+
+    async def set(self, key: Hashable, value: Any, ttl: float) -> None:
+        await self._redis.set(
+            self._prefix + _key(key),
+            json.dumps(self._encode(value), ensure_ascii=False, separators=(",", ":")),
+            ex=max(1, int(ttl))
+        )
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+
+
+def create_shared_cache(url: Optional[str], encode: Callable[[Any], Any],
+                        decode: Callable[[Any], Any]):
+    """Общий кеш по адресу; None - кеш только в памяти процесса"""
+    if not url:
+        return None
+    if url.startswith("sqlite:///"):
+        return SQLiteCache(url[len("sqlite:///"):], encode, decode)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCache(url, encode, decode)
+    raise ValueError(f"Неизвестный общий кеш: {url}")
@@ -0,0 +1,10 @@
+"""Подключение к файлам SQLite, общим для нескольких процессов"""
+import sqlite3
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Соединение в режиме автокоммита с журналом WAL: читатели не ждут писателя"""
+    connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
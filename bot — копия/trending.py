@@ -0,0 +1,160 @@
+"""Популярное на TMDB: фоновое обновление и готовые тексты сообщений.
+
+Тренды меняются не чаще раза в день, поэтому /trending не ходит в API:
+фоновая задача забирает фильмы и сериалы за день и за неделю, сразу
+собирает из них HTML сообщений и сохраняет на диск. Если TMDB недоступен,
+остаётся последний удачный снимок (в том числе после перезапуска).
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from html import escape
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MOVIE = "movie"
+TV = "tv"
+DAY = "day"
+WEEK = "week"
+WINDOWS: Tuple[Tuple[str, str], ...] = ((MOVIE, WEEK), (MOVIE, DAY), (TV, WEEK), (TV, DAY))
+
+TITLES = {
+    (MOVIE, WEEK): "📈 <b>Популярные фильмы недели:</b>",
+    (MOVIE, DAY): "📈 <b>Популярные фильмы сегодня:</b>",
+    (TV, WEEK): "📈 <b>Популярные сериалы недели:</b>",
+    (TV, DAY): "📈 <b>Популярные сериалы сегодня:</b>",
+}
+# Слова после /trending
+_ARG_ALIASES = {
+    "tv": TV, "сериал": TV, "сериалы": TV, "movie": MOVIE, "фильм": MOVIE, "фильмы": MOVIE,
+    "day": DAY, "день": DAY, "сегодня": DAY, "week": WEEK, "неделя": WEEK,
+}
+
+Fetcher = Callable[[str, str], Awaitable[Optional[List[dict]]]]
+
+
+def parse_trending_args(args: Optional[str]) -> Tuple[str, str]:
+    """'/trending tv day' -> ('tv', 'day'); по умолчанию фильмы за неделю"""
+    media_type, window = MOVIE, WEEK
+    for word in (args or "").lower().split():
+        value = _ARG_ALIASES.get(word)
+        if value in (MOVIE, TV):
+            media_type = value
+        elif value in (DAY, WEEK):
+            window = value
+    return media_type, window
+
+
+def render_trending(media_type: str, window: str, results: List[dict], limit: int,
+                    updated_at: float) -> str:
+    """HTML сообщения из ответа TMDB /trending"""
+    lines = [TITLES[(media_type, window)], ""]
+    for i, item in enumerate(results[:limit], 1):
+        title = item.get("title") or item.get("name") or "Без названия"
+        date = item.get("release_date") or item.get("first_air_date") or ""
+        year = f" ({date[:4]})" if date else ""
+        lines.append(f"{i}. <b>{escape(title)}</b>{year} ⭐ {item.get('vote_average', 0):.1f}/10")
+    lines.append("")
+    lines.append(f"<i>Обновлено {datetime.fromtimestamp(updated_at):%d.%m %H:%M}</i>")
+    return "\n".join(lines)
+
+
+class TrendingBoard:
+    """Готовые сообщения /trending по (тип, окно) с фоновым обновлением"""
+
+    def __init__(self, fetch: Fetcher, path: Optional[str] = None, limit: int = 5,
+                 interval: float = 3600, retry_interval: float = 300):
+        self.fetch = fetch
+        self.path = path
+        self.limit = limit
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self._texts: Dict[Tuple[str, str], str] = {}
+        self._updated_at: Dict[Tuple[str, str], float] = {}
+        # Текст на случай, когда удачного снимка ещё не было, - по типу
+        self._fallback: Dict[str, str] = {}
+        self.refreshed = 0
+        self.failed = 0
+        self._load()
+
+    def _load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Trending snapshot not loaded from {self.path}: {e}")
+            return
+        for key in WINDOWS:
+            entry = saved.get(":".join(key))
+            if entry:
+                self._texts[key] = entry["text"]
+                self._updated_at[key] = entry["updated_at"]
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+        data = {":".join(key): {"text": self._texts[key], "updated_at": self._updated_at[key]}
+                for key in self._texts}
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Trending snapshot not saved to {self.path}: {e}")
+
+    def set_fallback(self, media_type: str, text: str) -> None:
+        self._fallback[media_type] = text
+
+    def text(self, media_type: str = MOVIE, window: str = WEEK) -> Optional[str]:
+        """Готовый текст; без обращений к сети и без форматирования"""
+        return self._texts.get((media_type, window)) or self._fallback.get(media_type)
+
+    def age(self, media_type: str = MOVIE, window: str = WEEK) -> Optional[float]:
+        updated_at = self._updated_at.get((media_type, window))
+        return time.time() - updated_at if updated_at else None
+
+    async def refresh(self) -> bool:
+        """Обновляет все окна; неудачное окно сохраняет прежний текст.
+        True - если обновились все"""
+        updated = 0
+        for media_type, window in WINDOWS:
+            try:
+                results = await self.fetch(media_type, window)
+            except Exception as e:
+                logger.error(f"Trending {media_type}/{window} error: {e}")
+                results = None
+            if not results:
+                self.failed += 1
+                continue
+            now = time.time()
+            self._texts[(media_type, window)] = render_trending(media_type, window, results, self.limit, now)
+            self._updated_at[(media_type, window)] = now
+            self.refreshed += 1
+            updated += 1
+        if updated:
+            self._save()
+        return updated == len(WINDOWS)
+
+    async def run(self) -> None:
+        """Бесконечный цикл обновления; после неудачи повтор раньше обычного"""
+        while True:
+            try:
+                ok = await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Trending refresh failed: {e}")
+                ok = False
+            await asyncio.sleep(self.interval if ok else self.retry_interval)
+
+    def stats(self) -> Dict:
+        ages = [self.age(*key) for key in self._updated_at]
+        return {"refreshed": self.refreshed, "failed": self.failed, "windows": len(self._texts),
+                "oldest_age": round(max(ages)) if ages else None}
@@ -0,0 +1,148 @@
+"""Словари жанров, настроений и типов: интернированные строки и битовые маски.
+
+Здесь же всё, что из них следует для интерфейса: множества для проверки
+ввода, клавиатуры и тексты сообщений. Всё строится один раз при импорте;
+объекты aiogram неизменяемы, поэтому одна клавиатура служит всем сообщениям.
+"""
+import sys
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from aiogram.types import KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
+
+GENRES: Tuple[str, ...] = (
+    "комедия", "драма", "фантастика", "боевик", "триллер",
+    "романтика", "ужасы", "детектив", "приключения", "аниме",
+    "семейный", "мультфильм", "история", "биография",
+)
+MOODS: Tuple[str, ...] = (
+    "весёлое", "грустное", "романтичное", "страшное", "захватывающее",
+    "расслабляющее", "вдохновляющее", "ностальгическое", "интеллектуальное",
+)
+MEDIA_TYPES: Tuple[str, ...] = ("фильм", "сериал", "мультфильм", "аниме", "любой")
+# Код типа для числовых признаков (ранжирование, столбцы снимка каталога)
+TYPE_CODES: Dict[str, int] = {name: code for code, name in enumerate(MEDIA_TYPES)}
+UNKNOWN_TYPE_CODE = -3
+
+# Названия жанров у источников, которые совпадают с нашими
+GENRE_ALIASES = {"мелодрама": "романтика"}
+
+# Проверка ввода пользователя
+GENRE_SET = frozenset(GENRES)
+MOOD_SET = frozenset(MOODS)
+MEDIA_TYPE_SET = frozenset(MEDIA_TYPES)
+
+# Кнопки
+DONE_BUTTON = "✅ Готово"
+WATCH_BUTTON = "🎬 Буду смотреть!"
+NEXT_BUTTON = "➡️ Следующий вариант"
+RESTART_YES_BUTTON = "Да, ищу дальше!"
+RESTART_NO_BUTTON = "Нет, не сегодня"
+
+
+class Vocabulary:
+    """Фиксированный словарь + значения, встреченные в данных.
+
+    Каждое значение получает номер бита: набор значений хранится одним int,
+    пересечение наборов - побитовое И. Строки интернируются, поэтому тысячи
+    карточек ссылаются на одни и те же объекты. Номера битов для значений
+    вне фиксированного словаря зависят от порядка появления, поэтому
+    сохранять на диск можно только fixed_mask(), а не mask().
+    """
+
+    def __init__(self, names: Iterable[str], aliases: Optional[Dict[str, str]] = None):
+        self._names: List[str] = []
+        self._bits: Dict[str, int] = {}
+        self._aliases = {k: v for k, v in (aliases or {}).items()}
+        for name in names:
+            self.bit(name)
+        self._fixed_size = len(self._names)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __contains__(self, name: str) -> bool:
+        return self._normalize(name) in self._bits
+
+    def _normalize(self, name: str) -> str:
+        name = name.strip().lower()
+        return self._aliases.get(name, name)
+
+    def bit(self, name: str) -> int:
+        """Номер бита значения (новое значение добавляется в словарь)"""
+        name = self._normalize(name)
+        bit = self._bits.get(name)
+        if bit is None:
+            bit = len(self._names)
+            self._names.append(sys.intern(name))
+            self._bits[name] = bit
+        return bit
+
+    def mask(self, names: Iterable[str]) -> int:
+        mask = 0
+        for name in names or ():
+            if name:
+                mask |= 1 << self.bit(name)
+        return mask
+
+    def fixed_mask(self, names: Iterable[str]) -> int:
+        """Маска только по фиксированному словарю: номера битов не зависят от данных"""
+        mask = 0
+        for name in names or ():
+            bit = self._bits.get(self._normalize(name)) if name else None
+            if bit is not None and bit < self._fixed_size:
+                mask |= 1 << bit
+        return mask
+
+    def names(self, mask: int) -> List[str]:
+        """Названия в порядке битов (порядок словаря), а не в порядке источника"""
+        result = []
+        bit = 0
+        while mask:
+            if mask & 1:
+                result.append(self._names[bit])
+            mask >>= 1
+            bit += 1
+        return result
+
+
+GENRE_VOCAB = Vocabulary(GENRES, aliases=GENRE_ALIASES)
+MOOD_VOCAB = Vocabulary(MOODS)
+
+
+def _reply_keyboard(values: Sequence[str], columns: int = 3,
+                    last_row: Sequence[str] = ()) -> ReplyKeyboardMarkup:
+    buttons = [KeyboardButton(text=value) for value in values]
+    rows = [buttons[i:i + columns] for i in range(0, len(buttons), columns)]
+    if last_row:
+        rows.append([KeyboardButton(text=text) for text in last_row])
+    return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True)
+
+
+# Клавиатуры
+GENRES_KEYBOARD = _reply_keyboard(GENRES, last_row=[DONE_BUTTON])
+MOOD_KEYBOARD = _reply_keyboard(MOODS, last_row=[DONE_BUTTON])
+TYPE_KEYBOARD = _reply_keyboard(MEDIA_TYPES)
+REACTION_KEYBOARD = _reply_keyboard([WATCH_BUTTON, NEXT_BUTTON], columns=1)
+CONFIRM_RESTART_KEYBOARD = _reply_keyboard([RESTART_YES_BUTTON, RESTART_NO_BUTTON], columns=1)
+REMOVE_KEYBOARD = ReplyKeyboardRemove()
+
+# Ответы на выбор значения: словари конечны, поэтому тексты готовы заранее
+GENRE_ADDED = {genre: f"✅ Жанр <b>'{genre}'</b> добавлен!" for genre in GENRES}
+GENRE_REMOVED = {genre: f"❌ Жанр <b>'{genre}'</b> удалён" for genre in GENRES}
+MOOD_ADDED = {mood: f"✅ Настроение <b>'{mood}'</b> добавлено!" for mood in MOODS}
+MOOD_REMOVED = {mood: f"❌ Настроение <b>'{mood}'</b> удалено" for mood in MOODS}
+
+# Шаблоны сообщений с переменной частью: TEMPLATE(...) -> str
+SELECTED_TEMPLATE = ("📋 Выбрано: <b>{}</b>\nНажмите '" + DONE_BUTTON + "' когда закончите").format
+GENRES_DONE_TEMPLATE = "✅ Выбраны жанры: <b>{}</b>\n\nТеперь выберите настроение для просмотра:".format
+MOOD_DONE_TEMPLATE = "✅ Настроение: <b>{}</b>\n\nТеперь выберите тип:".format
+SUMMARY_TEMPLATE = (
+    "🎯 <b>Ваши предпочтения:</b>\n\n"
+    "<b>Жанры:</b> {genres}\n"
+    "<b>Настроение:</b> {moods}\n"
+    "<b>Тип:</b> {media_type}\n\n"
+    "🔍 Ищу рекомендации по вашим критериям..."
+).format
+
+TYPE_EMOJI = {"фильм": "🎥", "сериал": "📺", "мультфильм": "🐭", "аниме": "🌸"}
+SOURCE_EMOJI = {"tmdb": "🎞️", "kinopoisk": "🎬", "kadikama": "💫", "local": "🏠"}
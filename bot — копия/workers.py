@@ -0,0 +1,166 @@
+"""Несколько процессов-обработчиков за одним маршрутизатором обновлений.
+
+Маршрутизатор получает обновления Telegram (long polling или webhook) и
+пересылает каждое по HTTP обработчику номер chat_id % N - это тот же бот
+в режиме webhook на локальном порту. Обновления одного чата пересылаются
+строго по очереди: следующее уходит, только когда обработчик закончил
+предыдущее. Поэтому порядок действий пользователя сохраняется, а разные
+чаты обрабатываются параллельно и на разных ядрах.
+"""
+import asyncio
+import logging
+import os
+import subprocess
+import sys
+from collections import deque
+from typing import Any, Deque, Dict, List, Mapping, Optional
+
+import aiohttp
+
+from resilience import RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+# Обновления, у которых есть чат
+_CHAT_FIELDS = ("message", "edited_message", "channel_post", "edited_channel_post",
+                "business_message", "my_chat_member", "chat_member", "chat_join_request")
+# Обновления без чата: маршрутизируются по пользователю
+_USER_FIELDS = ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query")
+
+
+def update_chat_id(update: Mapping[str, Any]) -> int:
+    """Чат (или пользователь), к которому относится обновление; 0 - если его нет"""
+    for field in _CHAT_FIELDS:
+        if field in update:
+            return update[field]["chat"]["id"]
+    callback = update.get("callback_query")
+    if callback:
+        message = callback.get("message")
+        return message["chat"]["id"] if message else callback["from"]["id"]
+    for field in _USER_FIELDS:
+        if field in update:
+            return update[field]["from"]["id"]
+    return 0
+
+
+class UpdateRouter:
+    """Раздаёт обновления обработчикам, сохраняя порядок внутри чата"""
+
+    def __init__(self, worker_urls: List[str], secret: Optional[str] = None,
+                 retry_policy: Optional[RetryPolicy] = None, timeout: float = 60.0):
+        self.worker_urls = list(worker_urls)
+        self.secret = secret
+        self.retry_policy = retry_policy or RetryPolicy(attempts=3, base_delay=0.5, max_delay=5.0)
+        self.timeout = timeout
+        self._queues: Dict[int, Deque[Mapping[str, Any]]] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.routed = 0
+        self.failed = 0
+
+    def worker_for(self, chat_id: int) -> int:
+        return chat_id % len(self.worker_urls)
+
+    def route(self, update: Mapping[str, Any]) -> None:
+        """Ставит обновление в очередь его чата"""
+        chat_id = update_chat_id(update)
+        self._queues.setdefault(chat_id, deque()).append(update)
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = asyncio.create_task(self._drain(chat_id))
+
+    async def _drain(self, chat_id: int) -> None:
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                await self._forward(chat_id, queue[0])
+                queue.popleft()
+        finally:
+            del self._queues[chat_id]
+            del self._tasks[chat_id]
+
+    async def _forward(self, chat_id: int, update: Mapping[str, Any]) -> None:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        url = self.worker_urls[self.worker_for(chat_id)]
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret} if self.secret else None
+
+        last_error = None
+        for attempt in range(self.retry_policy.attempts):
+            if attempt:
+                await asyncio.sleep(self.retry_policy.delay(attempt - 1))
+            try:
+                async with self._session.post(url, json=update, headers=headers) as response:
+                    if response.status < 500:
+                        if response.status != 200:
+                            logger.warning(f"Worker {url} rejected update {update.get('update_id')}: "
+                                           f"HTTP {response.status}")
+                        self.routed += 1
+                        return
+                    last_error = f"HTTP {response.status}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                last_error = repr(e)
+
+        self.failed += 1
+        logger.error(f"Update {update.get('update_id')} for chat {chat_id} dropped "
+                     f"after {self.retry_policy.attempts} attempts to {url}: {last_error}")
+
+    async def wait_ready(self, health_urls: List[str], timeout: float = 30.0) -> None:
+        """Ждёт, пока все обработчики ответят на проверку живости"""
+        deadline = asyncio.get_running_loop().time() + timeout
+        async with aiohttp.ClientSession() as session:
+            for url in health_urls:
+                while True:
+                    try:
+                        async with session.get(url) as response:
+                            if response.status == 200:
+                                break
+                    except aiohttp.ClientError:
+                        pass
+                    if asyncio.get_running_loop().time() > deadline:
+                        raise RuntimeError(f"Worker is not ready: {url}")
+                    await asyncio.sleep(0.2)
+
+    async def close(self, timeout: float = 30.0) -> None:
+        """Досылает очереди (не дольше timeout секунд) и закрывает сессию"""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks.values()), timeout=timeout)
+        for task in list(self._tasks.values()):
+            task.cancel()
+        if self._session:
+            await self._session.close()
+
+    def stats(self) -> Dict[str, int]:
+        return {"routed": self.routed, "failed": self.failed, "chats_pending": len(self._queues)}
+
+
+def spawn_workers(script: str, count: int, host: str, base_port: int,
+                  env: Mapping[str, str]) -> List[subprocess.Popen]:
+    """Запускает count копий бота в режиме webhook на портах base_port..."""
+    processes = []
+    for worker_id in range(count):
+        worker_env = dict(os.environ)
+        worker_env.update(env)
+        worker_env.update(
+            WORKER_ID=str(worker_id),
+            BOT_MODE="webhook",
+            WEBHOOK_URL="",  # webhook Telegram регистрирует маршрутизатор
+            WEBAPP_HOST=host,
+            WEBAPP_PORT=str(base_port + worker_id),
+        )
+        # Своя группа процессов: Ctrl+C получает только маршрутизатор и
+        # останавливает обработчики сам, после того как дошлёт им очереди
+        processes.append(subprocess.Popen([sys.executable, script], env=worker_env, start_new_session=True))
+    return processes
+
+
+def stop_workers(processes: List[subprocess.Popen], timeout: float = 30.0) -> None:
+    """SIGTERM - обработчик дорабатывает принятые обновления; затем kill"""
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Worker {process.pid} did not stop in {timeout:.0f}s, killing")
+            process.kill()